@@ -1,16 +1,33 @@
-from flask import Flask, request, jsonify, render_template, Response, stream_with_context
-from anthropic import Anthropic
+from flask import Flask, request, jsonify, render_template, Response, stream_with_context, g
+from anthropic import Anthropic, NotFoundError
 from dotenv import load_dotenv
-from system_prompt import get_system_prompt, get_mode_instruction, get_explain_followup_instruction
+from system_prompt import approx_token_count, get_system_prompt, get_compiled_prompt, get_mode_instruction, get_explain_followup_instruction
+from plot_worker import PlotWorkerPool
+from plot_cache import PlotCache, plot_cache_key, plot_digest
+from image_pipeline import ImageRejected, image_stats, normalize_image
+from session_store import MemorySessionStore, SQLiteSessionStore
+from auth_cache import VerifiedTokenCache
+from response_cache import ResponseCache, replay_chunks, response_cache_key
+from single_flight import SingleFlight
+from timing import RequestTimer
+import metrics
+import response_scan
+from contextlib import closing
 from functools import wraps
 import os
-import uuid
 import re
+import hashlib
+import hmac
 import subprocess
 import sys
 import tempfile
 import base64
 import json
+import atexit
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 import firebase_admin
 from firebase_admin import auth as firebase_auth
 
@@ -18,8 +35,39 @@ load_dotenv()
 
 app = Flask(__name__)
 
-# In-memory conversation storage
-conversations = {}
+# Conversation storage, bounded by session count and bytes, least recently used
+# sessions evicted first and idle sessions swept. "memory" only works with one
+# gunicorn worker; "sqlite" is shared by every worker process on the host, and
+# runs with gthread workers (gunicorn.conf.py), since its calls block gevent.
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "memory")
+SESSION_DB_PATH = os.environ.get("SESSION_DB_PATH", os.path.join(tempfile.gettempdir(), "nexmath-sessions.db"))
+SESSION_MAX = int(os.environ.get("SESSION_MAX", "1000"))
+SESSION_MAX_MB = float(os.environ.get("SESSION_MAX_MB", "256"))
+SESSION_IDLE_TTL = float(os.environ.get("SESSION_IDLE_TTL", str(6 * 3600)))
+SESSION_IMAGE_MB = float(os.environ.get("SESSION_IMAGE_MB", "64"))
+
+# Uploaded images: "transcribe" stores each image once by content hash and, after
+# its first turn, sends the model's own transcription upstream instead of the
+# image; "full" resends the image on every turn until it is trimmed away.
+IMAGE_HISTORY_MODE = os.environ.get("IMAGE_HISTORY_MODE", "transcribe")
+IMAGE_TRANSCRIPTION_CHARS = 1200
+
+if SESSION_BACKEND == "sqlite":
+    conversations = SQLiteSessionStore(
+        SESSION_DB_PATH,
+        max_sessions=SESSION_MAX,
+        max_bytes=int(SESSION_MAX_MB * 1024 * 1024),
+        idle_ttl=SESSION_IDLE_TTL,
+        max_image_bytes=int(SESSION_IMAGE_MB * 1024 * 1024),
+    )
+else:
+    conversations = MemorySessionStore(
+        max_sessions=SESSION_MAX,
+        max_bytes=int(SESSION_MAX_MB * 1024 * 1024),
+        idle_ttl=SESSION_IDLE_TTL,
+        max_image_bytes=int(SESSION_IMAGE_MB * 1024 * 1024),
+    )
+conversations.start_sweeper()
 
 # Initialize Anthropic client
 client = Anthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
@@ -27,104 +75,249 @@ client = Anthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
 # Model configuration
 MODEL = os.environ.get("CLAUDE_MODEL", "claude-sonnet-4-20250514")
 MAX_TOKENS = 4096
-MAX_MESSAGES = 40
+# Context budget (estimated tokens) for system prompt + history + new turn + reply
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "150000"))
+# Vision tokens per image (the API downsizes images to about 1.15 megapixels, ~1600 tokens)
+IMAGE_TOKEN_ESTIMATE = 1600
+
+# Mark the system prompt and conversation prefix as cacheable upstream
+PROMPT_CACHING = os.environ.get("PROMPT_CACHING", "1") == "1"
+
+# Opt-in cache of first-turn answers (empty history, no image), keyed on the
+# normalized message, mode, options and system-prompt hash. RESPONSE_CACHE_MODES
+# lists the modes it applies to; entries expire after RESPONSE_CACHE_TTL seconds.
+RESPONSE_CACHE = os.environ.get("RESPONSE_CACHE", "0") == "1"
+RESPONSE_CACHE_MODES = tuple(
+    m.strip() for m in os.environ.get("RESPONSE_CACHE_MODES", "explain,quiz,solve").split(",") if m.strip()
+)
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", str(24 * 3600)))
+RESPONSE_CACHE_MAX = int(os.environ.get("RESPONSE_CACHE_MAX", "2000"))
+RESPONSE_CACHE_MB = float(os.environ.get("RESPONSE_CACHE_MB", "32"))
+
+# Identical requests in flight at the same time share one upstream generation
+UPSTREAM_COALESCE = os.environ.get("UPSTREAM_COALESCE", "1") == "1"
+
+# /api/chat-batch: problems per request, and how many are answered at once
+# (one pool per worker process, shared by every batch)
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "50"))
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "4"))
+
+# Report per-stage latency in Server-Timing headers and a final "timing" SSE event
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "1") == "1"
+
+# /api/metrics is open like /api/health unless a bearer token is configured
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+METRICS_MODES = ("solve", "explain", "quiz", "exam")
+
+# Uploaded image normalization: long-edge limit (px), upload limit (MB), output encoding
+IMAGE_MAX_EDGE = int(os.environ.get("IMAGE_MAX_EDGE", "1568"))
+IMAGE_MAX_MB = float(os.environ.get("IMAGE_MAX_MB", "10"))
+IMAGE_FORMAT = os.environ.get("IMAGE_FORMAT", "JPEG").upper()
+IMAGE_QUALITY = int(os.environ.get("IMAGE_QUALITY", "85"))
+
+# Plot rendering: warm worker pool size, jobs per worker before recycling, per-job timeout (s)
+PLOT_POOL_SIZE = int(os.environ.get("PLOT_POOL_SIZE", "2"))
+PLOT_WORKER_MAX_JOBS = int(os.environ.get("PLOT_WORKER_MAX_JOBS", "50"))
+PLOT_TIMEOUT = float(os.environ.get("PLOT_TIMEOUT", "15"))
+PLOT_DPI = 100
+# Wall-clock budget for all plot blocks of one response; late blocks fall back to code
+PLOT_RESPONSE_DEADLINE = float(os.environ.get("PLOT_RESPONSE_DEADLINE", "20"))
+
+# Rendered plot cache: memory LRU budget (MB), optional disk directory and its budget (MB)
+PLOT_CACHE_MB = float(os.environ.get("PLOT_CACHE_MB", "64"))
+PLOT_CACHE_DIR = os.environ.get("PLOT_CACHE_DIR", "")
+PLOT_CACHE_DISK_MB = float(os.environ.get("PLOT_CACHE_DISK_MB", "256"))
+
+# Plot delivery: "url" serves PNGs from /api/plots/<hash>, "inline" embeds data URIs.
+# The store's disk directory is shared by every worker process on the host, but not
+# across hosts: behind a load balancer without sticky sessions, or once a PNG is
+# evicted past PLOT_STORE_DISK_MB, its URL returns 404. Set PLOT_DELIVERY=inline
+# there, or point PLOT_STORE_DIR at storage every host mounts.
+PLOT_DELIVERY = os.environ.get("PLOT_DELIVERY", "url")
+PLOT_STORE_MB = float(os.environ.get("PLOT_STORE_MB", "32"))
+PLOT_STORE_DIR = os.environ.get("PLOT_STORE_DIR", os.path.join(tempfile.gettempdir(), "nexmath-plots"))
+PLOT_STORE_DISK_MB = float(os.environ.get("PLOT_STORE_DISK_MB", "512"))
+
 _PLOT_PYTHON = None
+_PLOT_POOL = None
+_PLOT_EXECUTOR = None
+_BATCH_EXECUTOR = None
+_PLOT_POOL_LOCK = threading.Lock()
+_PLOT_DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+# "look at the image again", "re-read the original photo", ...
+_IMAGE_WORD_RE = re.compile(r"\b(image|picture|photo|screenshot|pic)\b", re.IGNORECASE)
+_IMAGE_AGAIN_RE = re.compile(r"\b(again|original|re-?(read|check|examine|look))\b", re.IGNORECASE)
+
+plot_cache = PlotCache(
+    max_bytes=int(PLOT_CACHE_MB * 1024 * 1024),
+    disk_dir=PLOT_CACHE_DIR or None,
+    disk_max_bytes=int(PLOT_CACHE_DISK_MB * 1024 * 1024),
+)
+
+# Rendered PNGs addressed by their own hash, served by /api/plots/<hash>
+plot_store = PlotCache(
+    max_bytes=int(PLOT_STORE_MB * 1024 * 1024),
+    disk_dir=PLOT_STORE_DIR or None,
+    disk_max_bytes=int(PLOT_STORE_DISK_MB * 1024 * 1024),
+)
+
+response_cache = ResponseCache(
+    ttl=RESPONSE_CACHE_TTL,
+    max_entries=RESPONSE_CACHE_MAX,
+    max_bytes=int(RESPONSE_CACHE_MB * 1024 * 1024),
+)
+upstream_flights = SingleFlight()
 _FIREBASE_READY = False
 
+registry = metrics.Registry()
+http_requests = registry.counter(
+    "nexmath_http_requests_total", "HTTP requests by route, method and status.",
+    ("route", "method", "status"),
+)
+http_request_seconds = registry.histogram(
+    "nexmath_http_request_duration_seconds",
+    "Time from request start to the last byte sent (end of stream for SSE), by route and mode.",
+    ("route", "mode"),
+)
+upstream_ttft_seconds = registry.histogram(
+    "nexmath_upstream_ttft_seconds", "Time to the first streamed text chunk from the Messages API.", ("mode",),
+)
+upstream_seconds = registry.histogram(
+    "nexmath_upstream_duration_seconds", "Duration of Messages API calls, by mode and streaming.",
+    ("mode", "stream"),
+)
+upstream_tokens = registry.counter(
+    "nexmath_upstream_tokens_total", "Tokens reported by the Messages API, by mode and kind.", ("mode", "kind"),
+)
+plot_render_seconds = registry.histogram(
+    "nexmath_plot_render_seconds", "Plot render time on a worker (cache misses only).",
+    buckets=metrics.RENDER_BUCKETS,
+)
+plot_deadline_misses = registry.counter(
+    "nexmath_plot_deadline_misses_total", "Plot blocks still rendering at the response deadline.",
+)
+
+# Verified ID tokens kept until their exp, so repeat requests skip signature checks
+AUTH_CACHE_MAX = int(os.environ.get("AUTH_CACHE_MAX", "10000"))
+# Load tests only (bench/load_test.py): a bearer token accepted without Firebase.
+# Never set this in production.
+AUTH_BYPASS_TOKEN = os.environ.get("AUTH_BYPASS_TOKEN", "")
+if AUTH_BYPASS_TOKEN:
+    print("WARNING: AUTH_BYPASS_TOKEN is set; requests bearing it skip Firebase auth.")
+
+
+def _message_tokens(message):
+    """Estimated tokens of a stored message, computed once and cached on it as "_tokens"."""
+    tokens = message.get("_tokens")
+    if tokens is None:
+        content = message["content"]
+        if isinstance(content, str):
+            tokens = approx_token_count(content)
+        else:
+            tokens = sum(
+                IMAGE_TOKEN_ESTIMATE if block.get("type") in ("image", "image_ref")
+                else approx_token_count(block.get("text", ""))
+                for block in content
+            )
+        message["_tokens"] = tokens
+    return tokens
+
+
+def _history_message(role, content):
+    """A history entry with its token estimate precomputed, so every store persists it."""
+    message = {"role": role, "content": content}
+    _message_tokens(message)
+    return message
+
 
 def trim_conversation(messages):
-    """Keep conversation within context limits."""
-    if len(messages) <= MAX_MESSAGES:
+    """
+    Keep system prompt + history + the new turn within CONTEXT_TOKEN_BUDGET.
+
+    History is dropped a whole exchange (a user message and its replies) at a
+    time: oldest first after the opening exchange, which goes last. The new
+    turn is always kept and the result always starts with a user message.
+    """
+    budget = CONTEXT_TOKEN_BUDGET - get_compiled_prompt().approx_tokens - MAX_TOKENS
+    total = sum(_message_tokens(m) for m in messages)
+    if total <= budget and (not messages or messages[0]["role"] == "user"):
         return messages
-    # Keep the first exchange for context + most recent messages
-    return messages[:2] + messages[-(MAX_MESSAGES - 2):]
+
+    starts = [i for i, m in enumerate(messages) if m["role"] == "user"]
+    if not starts:
+        return messages
+    bounds = list(zip(starts, starts[1:] + [len(messages)]))
+    total -= sum(_message_tokens(m) for m in messages[:starts[0]])
+
+    # Drop order: second exchange onward, then the opening one; never the new turn
+    history = bounds[:-1]
+    if not history:
+        # Only the new turn is left (an oversized paste); send it on its own
+        return messages[bounds[-1][0]:]
+    kept = set(range(len(history)))
+    for index in list(range(1, len(history))) + [0]:
+        if total <= budget:
+            break
+        start, end = history[index]
+        total -= sum(_message_tokens(m) for m in messages[start:end])
+        kept.discard(index)
+
+    trimmed = [m for index in sorted(kept) for m in messages[slice(*history[index])]]
+    return trimmed + messages[bounds[-1][0]:]
 
 
 def execute_python_code(code):
     """
-    Execute Python matplotlib code and return base64-encoded PNG.
+    Execute Python matplotlib code and return the PNG bytes.
     Returns None if execution fails.
     """
     try:
-        # Create a wrapper script that saves the plot
         # Remove any blocking show() calls to avoid timeouts
-        def _sanitize_code(raw):
-            lines = raw.splitlines()
-            cleaned = []
-            code_like = re.compile(
-                r'^\s*(#|import |from |plt\.|np\.|matplotlib|sns\.|ax\.|fig\.|'
-                r'for |if |elif |else:|while |def |class |with |try:|except |return|'
-                r'pass|break|continue|[A-Za-z_][A-Za-z0-9_]*(\s*,\s*[A-Za-z_][A-Za-z0-9_]*)*\s*=|'
-                r'[A-Za-z_][A-Za-z0-9_]*\s*\(|[\]\)\}])'
-            )
-            for line in lines:
-                if "```" in line:
-                    continue
-                if line.strip() == "":
-                    cleaned.append(line)
-                    continue
-                if code_like.search(line):
-                    cleaned.append(line)
-                else:
-                    cleaned.append("# " + line)
-            return "\n".join(cleaned)
-
-        sanitized_code = re.sub(r'^\s*plt\.show\(\)\s*$', '', code, flags=re.MULTILINE)
-        sanitized_code = _sanitize_code(sanitized_code)
-
-        wrapper = f"""
-import matplotlib
-matplotlib.use('Agg')  # Non-interactive backend
-import matplotlib.pyplot as plt
-import numpy as np
-
-# User code
-{sanitized_code}
-
-# Save the figure
-plt.savefig('plot.png', dpi=100, bbox_inches='tight')
-plt.close()
-"""
-
-        # Create temporary directory for execution
-        with tempfile.TemporaryDirectory() as tmpdir:
-            script_path = os.path.join(tmpdir, 'script.py')
-            plot_path = os.path.join(tmpdir, 'plot.png')
-
-            # Write script
-            with open(script_path, 'w') as f:
-                f.write(wrapper)
-
-            # Execute with timeout (5 seconds)
-            result = subprocess.run(
-                [_get_plot_python(), script_path],
-                cwd=tmpdir,
-                capture_output=True,
-                timeout=15,
-                text=True
-            )
-
-            # Check if plot was created
-            if os.path.exists(plot_path):
-                with open(plot_path, 'rb') as f:
-                    img_data = base64.b64encode(f.read()).decode('utf-8')
-                return img_data
-
-            if result.stderr:
-                print(f"Plot stderr: {result.stderr}")
-            if result.stdout:
-                print(f"Plot stdout: {result.stdout}")
-            if result.returncode != 0:
-                print(f"Plot process exited with code {result.returncode}")
-            else:
-                print("Plot execution completed but no plot was generated.")
-            return None
+        sanitized_code = response_scan.sanitize_plot_code(code)
+
+        # Identical code renders identically, so serve repeats from the cache
+        cache_key = plot_cache_key(sanitized_code, dpi=PLOT_DPI, backend="Agg")
+        png = plot_cache.get(cache_key)
+        if png is None:
+            # Render on a warm worker (matplotlib/numpy already imported there)
+            render_started = time.perf_counter()
+            png = _get_plot_pool().render(sanitized_code, dpi=PLOT_DPI)
+            plot_render_seconds.observe(time.perf_counter() - render_started)
+            plot_cache.put(cache_key, png)
+        return png or None
 
     except Exception as e:
         print(f"Code execution error: {e}")
         return None
 
 
+def _get_plot_pool():
+    """Create the shared plot worker pool on first use."""
+    global _PLOT_POOL
+    if _PLOT_POOL is None:
+        with _PLOT_POOL_LOCK:
+            if _PLOT_POOL is None:
+                _PLOT_POOL = PlotWorkerPool(
+                    _get_plot_python(),
+                    size=PLOT_POOL_SIZE,
+                    max_jobs=PLOT_WORKER_MAX_JOBS,
+                    timeout=PLOT_TIMEOUT,
+                )
+                atexit.register(_PLOT_POOL.shutdown)
+    return _PLOT_POOL
+
+
+def _warm_plot_pool():
+    """Pre-fork plot workers in the background so start-up is not delayed."""
+    def _warm():
+        try:
+            _get_plot_pool().start()
+        except Exception as e:
+            print(f"Plot pool warm-up failed: {e}")
+
+    threading.Thread(target=_warm, name="plot-pool-warmup", daemon=True).start()
+
+
 def _get_plot_python():
     """Pick a Python interpreter with matplotlib installed."""
     global _PLOT_PYTHON
@@ -149,70 +342,509 @@ def _get_plot_python():
     return _PLOT_PYTHON
 
 
-def process_response_with_plots(text, allow_plots=True):
+def _render_plot_blocks(codes, futures=None, timeout=None):
+    """
+    Render several plot blocks in parallel and return their PNG bytes in order.
+    ``futures`` holds renders already started for the leading blocks (see
+    PlotBlockStream). Blocks still running at the response deadline come back as None.
+    """
+    timeout = PLOT_RESPONSE_DEADLINE if timeout is None else timeout
+    futures = list(futures or [])[:len(codes)]
+    for code in codes[len(futures):]:
+        futures.append(_get_plot_executor().submit(execute_python_code, code))
+    done, not_done = wait(futures, timeout=timeout)
+    if not_done:
+        print(f"{len(not_done)} plot block(s) missed the {PLOT_RESPONSE_DEADLINE}s response deadline.")
+        plot_deadline_misses.inc(len(not_done))
+    return [f.result() if f in done else None for f in futures]
+
+
+class PlotBlockStream:
+    """
+    Incremental fence detector over streamed response text.
+
+    Uses the same fence scanner as process_response_with_plots, so ``futures``
+    lines up with the plot blocks of the final text. Each matplotlib block
+    starts rendering as soon as its closing fence arrives.
+    """
+
+    def __init__(self):
+        self._text = ""
+        self._scan_pos = 0
+        self._reported = set()
+        self.futures = []
+
+    def feed(self, chunk):
+        self._text += chunk
+        # A block can only close on a chunk that carries a backtick
+        if "`" not in chunk:
+            return
+        for fence in response_scan.iter_fences(self._text, self._scan_pos):
+            self._scan_pos = fence.end
+            if response_scan.is_plot_code(fence.code):
+                self.futures.append(_get_plot_executor().submit(execute_python_code, fence.code))
+
+    def completed(self):
+        """Yield (index, png) for renders that finished since the last call."""
+        for index, future in enumerate(self.futures):
+            if index not in self._reported and future.done():
+                self._reported.add(index)
+                yield index, future.result()
+
+    def drain(self, timeout):
+        """Yield (index, png) for the remaining renders as they finish, up to ``timeout``."""
+        pending = [f for i, f in enumerate(self.futures) if i not in self._reported]
+        try:
+            for future in as_completed(pending, timeout=timeout):
+                index = self.futures.index(future)
+                self._reported.add(index)
+                yield index, future.result()
+        except FuturesTimeoutError:
+            return
+
+
+def _get_plot_executor():
+    """Threads that wait on plot workers; sized to the pool so extra blocks queue here."""
+    global _PLOT_EXECUTOR
+    if _PLOT_EXECUTOR is None:
+        with _PLOT_POOL_LOCK:
+            if _PLOT_EXECUTOR is None:
+                _PLOT_EXECUTOR = ThreadPoolExecutor(
+                    max_workers=max(1, PLOT_POOL_SIZE), thread_name_prefix="plot-render"
+                )
+    return _PLOT_EXECUTOR
+
+
+def _get_batch_executor():
+    """Threads that answer batch problems; bounds upstream calls made for batches."""
+    global _BATCH_EXECUTOR
+    if _BATCH_EXECUTOR is None:
+        with _PLOT_POOL_LOCK:
+            if _BATCH_EXECUTOR is None:
+                _BATCH_EXECUTOR = ThreadPoolExecutor(
+                    max_workers=max(1, BATCH_CONCURRENCY), thread_name_prefix="chat-batch"
+                )
+    return _BATCH_EXECUTOR
+
+
+def _plot_image_src(png, inline=False):
+    """Return an <img> src for a rendered plot: a store URL, or a data URI when inline."""
+    if inline:
+        return "data:image/png;base64," + base64.b64encode(png).decode('utf-8')
+    digest = plot_digest(png)
+    plot_store.put(digest, png)
+    return f"/api/plots/{digest}"
+
+
+def process_response_with_plots(text, allow_plots=True, inline=None, plot_futures=None, plot_timeout=None):
     """
     Find Python code blocks in the response, execute them, and replace with images.
+    Images reference /api/plots/<hash> unless ``inline`` asks for data URIs.
+    ``plot_futures`` reuses renders a PlotBlockStream already started.
     """
     if not allow_plots:
         return text
-    # Pattern to match any fenced code block (handle CRLF)
-    pattern = r'```[^\n]*\r?\n(.*?)```'
+    if inline is None:
+        inline = PLOT_DELIVERY == "inline"
+    # One sweep finds every matplotlib block, so they can render concurrently
+    found = response_scan.scan(text)
+    if found.plots:
+        images = _render_plot_blocks(
+            [fence.code for fence in found.plots], futures=plot_futures, timeout=plot_timeout
+        )
+        # Splice images back in order; failed or late blocks keep their code
+        return response_scan.splice(text, found.plots, [
+            f'''<div class="plot-container">
+<img src="{_plot_image_src(png, inline)}" alt="Plot" class="matplotlib-plot">
+</div>''' if png else None
+            for png in images
+        ])
+
+    # Fallback: no fenced plot blocks, but matplotlib code appears outside a fence
+    if found.bare:
+        png = execute_python_code(found.bare.code)
+        if png:
+            image_html = (
+                f'<div class="plot-container">'
+                f'<img src="{_plot_image_src(png, inline)}" alt="Plot" class="matplotlib-plot">'
+                f'</div>'
+            )
+            return "\n".join([found.bare.before, image_html, found.bare.after]).strip()
+    return text
+
+
+def _system_blocks():
+    """System prompt as a content block marked for prompt caching."""
+    block = {"type": "text", "text": get_system_prompt()}
+    if PROMPT_CACHING:
+        block["cache_control"] = {"type": "ephemeral"}
+    return [block]
+
+
+def _request_messages(messages):
+    """
+    Copy of the history to send upstream, without bookkeeping keys ("_tokens")
+    and with a cache breakpoint on the last block so the whole conversation
+    prefix is reused on the next turn. The stored history is left untouched.
+    """
+    messages = [{"role": m["role"], "content": m["content"]} for m in messages]
+    if not PROMPT_CACHING or not messages:
+        return messages
+    last = messages[-1]
+    content = last["content"]
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    else:
+        content = list(content)
+    content[-1] = {**content[-1], "cache_control": {"type": "ephemeral"}}
+    return messages[:-1] + [{**last, "content": content}]
+
+
+def _usage_dict(usage):
+    """Token usage of one upstream call, including prompt-cache reads and writes."""
+    if usage is None:
+        return {}
+    return {
+        "input_tokens": getattr(usage, "input_tokens", 0) or 0,
+        "output_tokens": getattr(usage, "output_tokens", 0) or 0,
+        "cache_read_input_tokens": getattr(usage, "cache_read_input_tokens", 0) or 0,
+        "cache_creation_input_tokens": getattr(usage, "cache_creation_input_tokens", 0) or 0,
+    }
+
+
+def _stream_upstream(flight, system, upstream_messages):
+    """Run one streamed Messages API call, publishing its text to the flight's subscribers."""
+    with client.messages.stream(
+        model=MODEL,
+        max_tokens=MAX_TOKENS,
+        system=system,
+        messages=upstream_messages,
+    ) as stream:
+        for text in stream.text_stream:
+            if not text:
+                continue
+            flight.publish(text)
+            if flight.abandoned:
+                # Every client went away; stop generating tokens nobody will read
+                return {"usage": {}, "stop_reason": None}
+        message = stream.get_final_message()
+    return {"usage": _usage_dict(message.usage), "stop_reason": message.stop_reason}
+
+
+def _upstream_flight(system, upstream_messages, cache_key=None):
+    """
+    Join the generation already running for an identical request, or start one.
+    Returns (flight, started). Identical means the same upstream payload, or the
+    same response cache key when the request is a cacheable first turn.
+    """
+    key = None
+    if UPSTREAM_COALESCE:
+        key = cache_key or hashlib.sha256(
+            json.dumps([MODEL, MAX_TOKENS, system, upstream_messages], sort_keys=True).encode("utf-8")
+        ).hexdigest()
+    return upstream_flights.subscribe(key, lambda flight: _stream_upstream(flight, system, upstream_messages))
+
+
+def _image_block(media_type, data):
+    """
+    History block for an uploaded image. In "transcribe" mode the image goes to
+    the session store once, keyed by content hash, and history keeps a reference.
+    """
+    if IMAGE_HISTORY_MODE != "transcribe":
+        return {
+            "type": "image",
+            "source": {"type": "base64", "media_type": media_type, "data": data},
+        }
+    digest = hashlib.sha256(data.encode("utf-8")).hexdigest()
+    conversations.put_image(digest, media_type, data)
+    return {"type": "image_ref", "digest": digest, "media_type": media_type}
 
-    def replace_code_block(match):
-        code = match.group(1)
 
-        # Only execute if it contains matplotlib usage
-        if 'matplotlib' in code or 'plt.' in code:
-            img_base64 = execute_python_code(code)
+def _user_asked_for_image_again(text):
+    if not text:
+        return False
+    return (
+        _IMAGE_WORD_RE.search(text) is not None
+        and _IMAGE_AGAIN_RE.search(text) is not None
+    )
 
-            if img_base64:
-                # Replace with image only (no code block shown)
-                return f'''<div class="plot-container">
-<img src="data:image/png;base64,{img_base64}" alt="Plot" class="matplotlib-plot">
-</div>'''
 
-        # If execution failed or no matplotlib, keep original code block
-        return match.group(0)
+def _latest_image_ref(messages):
+    """Most recent image reference in the history, or None."""
+    for message in reversed(messages):
+        content = message["content"]
+        if isinstance(content, str):
+            continue
+        for block in content:
+            if block.get("type") == "image_ref":
+                return dict(block)
+    return None
+
+
+def _image_transcription(reply):
+    """Opening of the assistant reply that followed an image (it transcribes it first)."""
+    if not reply or not isinstance(reply["content"], str):
+        return ""
+    text = reply["content"]
+    if len(text) <= IMAGE_TRANSCRIPTION_CHARS:
+        return text
+    cut = text.rfind("\n\n", 0, IMAGE_TRANSCRIPTION_CHARS)
+    return text[:cut if cut > 0 else IMAGE_TRANSCRIPTION_CHARS] + " ..."
 
-    processed = re.sub(pattern, replace_code_block, text, flags=re.DOTALL)
 
-    # Fallback: if no fenced blocks matched but matplotlib code appears, try to extract it
-    if processed == text and ("matplotlib" in text or "plt." in text):
-        lines = text.splitlines()
-        start_idx = None
-        code_line_re = re.compile(
-            r'^\s*(#|import |from |plt\.|np\.|[A-Za-z_][A-Za-z0-9_]*\s*=|[A-Za-z_][A-Za-z0-9_]*\s*\()'
+def _resolve_image_refs(messages):
+    """
+    Expand image references for the upstream request: the newest message gets
+    the stored image; earlier ones get the transcription from the reply that
+    followed them, so each image is uploaded only on the turn it is needed.
+    """
+    last = len(messages) - 1
+    resolved = []
+    for index, message in enumerate(messages):
+        content = message["content"]
+        if isinstance(content, str) or not any(b.get("type") == "image_ref" for b in content):
+            resolved.append(message)
+            continue
+        blocks = []
+        for block in content:
+            if block.get("type") != "image_ref":
+                blocks.append(block)
+                continue
+            image = conversations.get_image(block["digest"]) if index == last else None
+            if image:
+                media_type, data = image
+                blocks.append({
+                    "type": "image",
+                    "source": {"type": "base64", "media_type": media_type, "data": data},
+                })
+                continue
+            reply = messages[index + 1] if index < last else None
+            transcription = _image_transcription(reply)
+            if transcription:
+                note = (
+                    "[The student attached an image here. It is no longer attached; "
+                    f"your reply began by transcribing it:]\n{transcription}"
+                )
+            else:
+                note = "[The student attached an image here. It is no longer available.]"
+            blocks.append({"type": "text", "text": note})
+        resolved.append({**message, "content": blocks})
+    return resolved
+
+
+def _run_blocking(fn, *args, **kwargs):
+    """
+    Call ``fn`` on a native thread when gevent has patched threading, so
+    CPU-bound work does not stall the event loop and every open stream with it.
+    """
+    monkey = sys.modules.get("gevent.monkey")
+    if monkey is not None and monkey.is_module_patched("threading"):
+        import gevent
+        return gevent.get_hub().threadpool.apply(fn, args, kwargs)
+    return fn(*args, **kwargs)
+
+
+def _normalize_upload(image_data, image_type):
+    """Decode, EXIF-rotate, downscale and re-encode an uploaded image."""
+    # Pillow work on a large photo takes hundreds of milliseconds
+    image_data, image_type, stats = _run_blocking(
+        normalize_image,
+        image_data,
+        image_type,
+        max_edge=IMAGE_MAX_EDGE,
+        max_input_bytes=int(IMAGE_MAX_MB * 1024 * 1024),
+        output_format=IMAGE_FORMAT,
+        quality=IMAGE_QUALITY,
+    )
+    print(f"Image normalized: {stats['bytes_in']} -> {stats['bytes_out']} bytes, "
+          f"{stats['size_in'][0]}x{stats['size_in'][1]} -> {stats['size_out'][0]}x{stats['size_out'][1]}")
+    return image_data, image_type
+
+
+def _user_prompt(mode, user_text, show_steps=True, explain_style="intuition", explain_action=None,
+                 original_concept=None, exam_answer=False, has_image=False):
+    """The user turn sent upstream: the student's message wrapped in its mode's instructions."""
+    # Apply mode instruction (or follow-up instruction for Explain mode)
+    if mode == "exam" and exam_answer:
+        prefixed_text = (
+            "Exam grading mode. The student is answering the previous exam problem. "
+            "Grade strictly and briefly: state whether it is correct, list 1–2 key errors "
+            "or confirmations, and give the final answer. Keep a formal, time-pressured tone.\n\n"
+            f"Student answer: {user_text}"
         )
+    elif mode == "explain" and explain_action:
+        prefixed_text = get_explain_followup_instruction(
+            explain_action, user_text, original_concept
+        )
+    else:
+        prefixed_text = get_mode_instruction(mode, user_text)
+        if mode == "solve" and not show_steps:
+            prefixed_text += "\n\nKeep the response concise. Do not show step-by-step work; provide only the final answer with a brief justification."
+        if mode == "solve":
+            prefixed_text += "\n\nInclude a 1–2 sentence real-world application."
+    if mode == "explain":
+        if explain_style == "equation":
+            prefixed_text += "\n\nStart with the formal definition/equation first, then provide intuition and examples."
+        else:
+            prefixed_text += "\n\nStart with intuition first, then introduce formal definitions/equations."
+    if mode in ("solve", "explain"):
+        prefixed_text += "\n\nEnd with a short 'Key takeaway' section (1–2 sentences)."
 
-        for i, line in enumerate(lines):
-            if re.search(r'^\s*(import matplotlib|from matplotlib|import numpy|import matplotlib\.pyplot)', line) or "plt." in line:
-                start_idx = i
-                break
-
-        if start_idx is not None:
-            end_idx = None
-            for i in range(start_idx, len(lines)):
-                if code_line_re.search(lines[i]) or lines[i].strip() == "":
-                    end_idx = i
-                else:
-                    # Stop when we hit a clear prose line after code started
-                    if end_idx is not None and i > end_idx + 1:
-                        break
-
-            if end_idx is not None:
-                code = "\n".join(lines[start_idx:end_idx + 1])
-                img_base64 = execute_python_code(code)
-                if img_base64:
-                    image_html = (
-                        f'<div class="plot-container">'
-                        f'<img src="data:image/png;base64,{img_base64}" alt="Plot" class="matplotlib-plot">'
-                        f'</div>'
-                    )
-                    before = "\n".join(lines[:start_idx])
-                    after = "\n".join(lines[end_idx + 1:])
-                    return "\n".join([before, image_html, after]).strip()
-
-    return processed
+    # If an image is included, ask for a clean transcription first
+    if has_image:
+        prefixed_text += "\n\nIf an image is provided, first transcribe the problem clearly before solving."
+    return prefixed_text
+
+
+def _response_cache_key(data, user_text, mode, image_data):
+    """
+    Response cache key for a request, or None when the cache does not apply.
+    The caller also checks that the conversation has no earlier turns.
+    """
+    if not RESPONSE_CACHE or mode not in RESPONSE_CACHE_MODES or image_data:
+        return None
+    # Follow-ups and exam answers depend on context the key does not capture
+    if data.get("explain_action") or data.get("exam_answer"):
+        return None
+    options = {
+        "show_steps": bool(data.get("show_steps", True)),
+        "explain_style": data.get("explain_style", "intuition"),
+        "plot_mode": data.get("plot_mode", "on_demand"),
+    }
+    return response_cache_key(user_text, mode, options, get_compiled_prompt().sha256, MODEL)
+
+
+def _ndjson(payload):
+    return json.dumps(payload) + "\n"
+
+
+def _batch_owner_tag(user_id):
+    """Marks a Message Batches API job as belonging to ``user_id`` (custom IDs are echoed back)."""
+    return hashlib.sha256(f"nexmath-batch:{user_id}".encode("utf-8")).hexdigest()[:24]
+
+
+def _batch_problem_errors(problems):
+    """Per-item errors for entries that are not a non-empty string, by index."""
+    return {
+        index: "Empty problem." if isinstance(problem, str) else "Problem must be a string."
+        for index, problem in enumerate(problems)
+        if not isinstance(problem, str) or not problem.strip()
+    }
+
+
+def _solve_batch_item(problem, mode, options, inline, system):
+    """
+    Answer one problem of a batch as a first turn with no session, through the
+    same response cache and coalescing as /api/chat. Returns its result fields.
+    """
+    started = time.perf_counter()
+    cache_key = _response_cache_key(options, problem, mode, None)
+    cached = response_cache.get(cache_key) if cache_key else None
+    if cached is not None:
+        text, usage = cached, {}
+    else:
+        prompt = _user_prompt(
+            mode, problem, show_steps=options["show_steps"], explain_style=options["explain_style"]
+        )
+        upstream_messages = _request_messages([{"role": "user", "content": [{"type": "text", "text": prompt}]}])
+        flight, flight_started = _upstream_flight(system, upstream_messages, cache_key)
+        text = "".join(flight.follow())
+        usage = flight.result["usage"] if flight_started else {}
+        if cache_key and flight.result["stop_reason"] == "end_turn":
+            response_cache.put(cache_key, text)
+
+    allow_plots = options["plot_mode"] == "auto" or _user_asked_for_plot(problem)
+    return {
+        "response": process_response_with_plots(text, allow_plots=allow_plots, inline=inline),
+        "usage": usage,
+        "cached": cached is not None,
+        "ms": round((time.perf_counter() - started) * 1000, 1),
+    }
+
+
+def _finish_batch_result(item, inline):
+    """Result fields for one entry of a finished Message Batches API job."""
+    result = item.result
+    if result.type != "succeeded":
+        error = result.error.error.message if result.type == "errored" else f"Request {result.type}."
+        raise RuntimeError(error)
+    text = "".join(block.text for block in result.message.content if block.type == "text")
+    allow_plots = item.custom_id.split("-")[1] == "p"
+    return {
+        "response": process_response_with_plots(text, allow_plots=allow_plots, inline=inline),
+        "usage": _usage_dict(result.message.usage),
+        "cached": False,
+    }
+
+
+def _stream_batch_results(futures, count, errors):
+    """
+    NDJSON lines for a batch: the per-item ``errors`` first, then one line per
+    future as it completes, then a "done" summary. ``futures`` maps future -> index.
+    Problems not yet started are dropped if the client goes away.
+    """
+    started = time.perf_counter()
+    usage = {}
+    failed = len(errors)
+    for index, error in sorted(errors.items()):
+        yield _ndjson({"type": "error", "index": index, "error": error})
+    try:
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                failed += 1
+                yield _ndjson({"type": "error", "index": index, "error": str(e)})
+                continue
+            for kind, tokens in result["usage"].items():
+                usage[kind] = usage.get(kind, 0) + tokens
+            yield _ndjson({"type": "result", "index": index, **result})
+    finally:
+        for future in futures:
+            future.cancel()
+    g.usage = usage
+    yield _ndjson({
+        "type": "done",
+        "count": count,
+        "failed": failed,
+        "usage": usage,
+        "ms": round((time.perf_counter() - started) * 1000, 1),
+    })
+
+
+def _submit_message_batch(problems, mode, options, system, errors):
+    """Queue the problems as one Message Batches API job (results within 24 hours, at lower cost)."""
+    owner = _batch_owner_tag(request.user_id)
+    requests = []
+    for index, problem in enumerate(problems):
+        if index in errors:
+            continue
+        problem = problem.strip()
+        prompt = _user_prompt(
+            mode, problem, show_steps=options["show_steps"], explain_style=options["explain_style"]
+        )
+        allow_plots = options["plot_mode"] == "auto" or _user_asked_for_plot(problem)
+        requests.append({
+            # Results come back unordered and without our request, so the ID carries what is needed later
+            "custom_id": f"{index}-{'p' if allow_plots else 'n'}-{owner}",
+            "params": {
+                "model": MODEL,
+                "max_tokens": MAX_TOKENS,
+                "system": system,
+                "messages": [{"role": "user", "content": prompt}],
+            },
+        })
+    item_errors = [{"index": index, "error": error} for index, error in sorted(errors.items())]
+    if not requests:
+        return jsonify({"error": "No valid problems to submit.", "errors": item_errors}), 400
+    batch = client.messages.batches.create(requests=requests)
+    return jsonify({
+        "batch_id": batch.id,
+        "status": batch.processing_status,
+        "count": len(requests),
+        "errors": item_errors,
+    }), 202
 
 
 def _user_asked_for_plot(text):
@@ -230,6 +862,121 @@ def _init_firebase():
     _FIREBASE_READY = True
 
 
+def _verify_firebase_token(token):
+    _init_firebase()
+    return firebase_auth.verify_id_token(token)
+
+
+token_cache = VerifiedTokenCache(_verify_firebase_token, max_entries=AUTH_CACHE_MAX)
+
+
+def _prefetch_signing_certs():
+    """Fetch Google's token signing certificates now rather than on the first request."""
+    from firebase_admin import _token_gen
+    try:
+        _init_firebase()
+        # The auth client's certificate session honors Cache-Control, so this
+        # primes the copy that verify_id_token reads from.
+        verifier = firebase_auth._get_client(None)._token_verifier
+        verifier.request(_token_gen.ID_TOKEN_CERT_URI, method="GET")
+    except Exception as e:
+        print(f"Signing certificates not prefetched: {e}")
+
+
+def _request_timer():
+    """The RequestTimer of the current request."""
+    timer = g.get("timer")
+    if timer is None:
+        timer = g.timer = RequestTimer()
+    return timer
+
+
+@app.before_request
+def _start_request_timer():
+    g.timer = RequestTimer()
+
+
+@app.after_request
+def _add_server_timing(response):
+    timer = g.get("timer")
+    if SERVER_TIMING and timer is not None and timer.as_dict(include_total=False):
+        # A streamed response sends its headers before the answer; its full
+        # breakdown arrives in the final "timing" event instead
+        response.headers["Server-Timing"] = timer.header(include_total=not response.is_streamed)
+    if timer is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        method, status, request_g = request.method, response.status_code, g._get_current_object()
+        # Runs once the last byte is sent, so streams are measured to their end
+        response.call_on_close(lambda: _record_request_metrics(route, method, status, timer, request_g))
+    return response
+
+
+def _record_request_metrics(route, method, status, timer, request_g):
+    mode = request_g.get("mode", "none")
+    http_requests.inc(route=route, method=method, status=status)
+    http_request_seconds.observe(timer.elapsed(), route=route, mode=mode)
+    spans = timer.as_dict(include_total=False)
+    # A request that joined another's generation made no upstream call of its own
+    shared = request_g.get("coalesced", False)
+    if "ttft" in spans and not shared:
+        upstream_ttft_seconds.observe(spans["ttft"] / 1000, mode=mode)
+        upstream_seconds.observe((spans["ttft"] + spans.get("generate", 0)) / 1000, mode=mode, stream="true")
+    elif "upstream" in spans and not shared:
+        upstream_seconds.observe(spans["upstream"] / 1000, mode=mode, stream="false")
+    for kind, count in request_g.get("usage", {}).items():
+        upstream_tokens.inc(count, mode=mode, kind=kind.replace("_tokens", ""))
+
+
+@registry.collector
+def _component_metrics():
+    """Gauges and counters owned by the session store, caches, plot pool and auth cache."""
+    families = []
+    sessions = conversations.stats()
+    families.append(("nexmath_sessions", "gauge", "Conversations held by the session store.",
+                     [({"backend": sessions["backend"]}, sessions["sessions"])]))
+    families.append(("nexmath_session_bytes", "gauge", "Message payload bytes held by the session store.",
+                     [({"backend": sessions["backend"]}, sessions["bytes"])]))
+    families.append(("nexmath_session_image_bytes", "gauge", "Uploaded image bytes held by the session store.",
+                     [({"backend": sessions["backend"]}, sessions["image_bytes"])]))
+    families.append(("nexmath_session_removals_total", "counter", "Sessions evicted for budget or expired idle.",
+                     [({"reason": "evicted"}, sessions["evictions"]), ({"reason": "expired"}, sessions["expirations"])]))
+
+    ratios, lookups = [], []
+    for cache, stats in (("plot_render", plot_cache.stats()), ("plot_store", plot_store.stats()),
+                         ("auth_token", token_cache.stats()), ("response", response_cache.stats())):
+        ratios.append(({"cache": cache}, stats["hit_ratio"]))
+        hits = stats.get("hits", stats.get("memory_hits", 0) + stats.get("disk_hits", 0))
+        lookups.append(({"cache": cache, "result": "hit"}, hits))
+        lookups.append(({"cache": cache, "result": "miss"}, stats["misses"]))
+    families.append(("nexmath_cache_hit_ratio", "gauge", "Hit ratio of each cache since start-up.", ratios))
+    families.append(("nexmath_cache_lookups_total", "counter", "Cache lookups by result.", lookups))
+
+    pool = _PLOT_POOL
+    if pool is not None:
+        pool_stats = pool.stats()
+        families.append(("nexmath_plot_jobs_total", "counter",
+                         "Plot jobs by outcome (rendered, failed, timed_out, saturated).",
+                         [({"outcome": k}, pool_stats[k]) for k in ("rendered", "failed", "timed_out", "saturated")]))
+        families.append(("nexmath_plot_workers", "gauge", "Live plot worker processes.",
+                         [({"state": "live"}, pool_stats["workers"]), ({"state": "idle"}, pool_stats["idle"])]))
+        families.append(("nexmath_plot_worker_recycles_total", "counter",
+                         "Plot workers retired (timeout, crash or job limit).", [({}, pool_stats["recycled"])]))
+
+    flights = upstream_flights.stats()
+    families.append(("nexmath_upstream_generations_total", "counter",
+                     "Upstream generations started, requests that joined one in flight, and generations abandoned.",
+                     [({"result": k}, flights[k]) for k in ("started", "joined", "abandoned")]))
+    families.append(("nexmath_upstream_generations_in_flight", "gauge", "Shareable upstream generations running now.",
+                     [({}, flights["in_flight"])]))
+
+    images = image_stats()
+    families.append(("nexmath_image_bytes_total", "counter", "Uploaded image bytes before and after normalization.",
+                     [({"stage": "in"}, images["bytes_in"]), ({"stage": "out"}, images["bytes_out"])]))
+    families.append(("nexmath_images_total", "counter", "Uploaded images by result.",
+                     [({"result": "normalized"}, images["images"]), ({"result": "rejected"}, images["rejected"])]))
+    return families
+
+
 def _unauthorized(message="Unauthorized"):
     return jsonify({"error": message}), 401
 
@@ -243,9 +990,12 @@ def require_auth(fn):
         token = auth_header.split(" ", 1)[1].strip()
         if not token:
             return _unauthorized()
+        if AUTH_BYPASS_TOKEN and hmac.compare_digest(token, AUTH_BYPASS_TOKEN):
+            request.user_id = "load-test"
+            return fn(*args, **kwargs)
         try:
-            _init_firebase()
-            decoded = firebase_auth.verify_id_token(token)
+            with _request_timer().span("auth"):
+                decoded = token_cache.verify(token)
             request.user_id = decoded.get("uid")
         except Exception:
             return _unauthorized()
@@ -262,6 +1012,7 @@ def index():
 @app.route("/api/chat", methods=["POST"])
 @require_auth
 def chat():
+    timer = _request_timer()
     data = request.json
 
     user_text = data.get("message", "").strip()
@@ -272,14 +1023,24 @@ def chat():
     explain_action = data.get("explain_action")  # "deeper", "differently", "verify", "review"
     original_concept = data.get("original_concept")  # Track concept being explained
     plot_mode = data.get("plot_mode", "on_demand")  # "auto" or "on_demand"
+    plot_delivery = data.get("plot_delivery")  # "url" or "inline"; defaults to PLOT_DELIVERY
     show_steps = data.get("show_steps", True)
     explain_style = data.get("explain_style", "intuition")
     exam_answer = data.get("exam_answer", False)
+    g.mode = mode if mode in METRICS_MODES else "other"
 
     # Need either text or image
     if not user_text and not image_data:
         return jsonify({"error": "Please provide a message or image."}), 400
 
+    # Normalize the upload before it is stored or sent upstream
+    if image_data:
+        try:
+            with timer.span("image"):
+                image_data, image_type = _normalize_upload(image_data, image_type)
+        except ImageRejected as e:
+            return jsonify({"error": str(e)}), 400
+
     # Default text when only an image is sent
     if not user_text and image_data:
         user_text = (
@@ -287,92 +1048,99 @@ def chat():
             "understand how to approach it."
         )
 
-    # Apply mode instruction (or follow-up instruction for Explain mode)
-    if mode == "exam" and exam_answer:
-        prefixed_text = (
-            "Exam grading mode. The student is answering the previous exam problem. "
-            "Grade strictly and briefly: state whether it is correct, list 1–2 key errors "
-            "or confirmations, and give the final answer. Keep a formal, time-pressured tone.\n\n"
-            f"Student answer: {user_text}"
-        )
-    elif mode == "explain" and explain_action:
-        prefixed_text = get_explain_followup_instruction(
-            explain_action, user_text, original_concept
-        )
-    else:
-        prefixed_text = get_mode_instruction(mode, user_text)
-        if mode == "solve" and not show_steps:
-            prefixed_text += "\n\nKeep the response concise. Do not show step-by-step work; provide only the final answer with a brief justification."
-        if mode == "solve":
-            prefixed_text += "\n\nInclude a 1–2 sentence real-world application."
-    if mode == "explain":
-        if explain_style == "equation":
-            prefixed_text += "\n\nStart with the formal definition/equation first, then provide intuition and examples."
-        else:
-            prefixed_text += "\n\nStart with intuition first, then introduce formal definitions/equations."
-    if mode in ("solve", "explain"):
-        prefixed_text += "\n\nEnd with a short 'Key takeaway' section (1–2 sentences)."
-
-    # If an image is included, ask for a clean transcription first
-    if image_data:
-        prefixed_text += "\n\nIf an image is provided, first transcribe the problem clearly before solving."
+    prefixed_text = _user_prompt(
+        mode, user_text, show_steps=show_steps, explain_style=explain_style, explain_action=explain_action,
+        original_concept=original_concept, exam_answer=exam_answer, has_image=bool(image_data),
+    )
 
     # Session management
-    if not session_id or session_id not in conversations:
-        session_id = str(uuid.uuid4())
-        conversations[session_id] = []
+    history_started = time.perf_counter()
+    if not session_id or not conversations.exists(session_id):
+        session_id = conversations.create()
 
     # Build content blocks for Claude API
     content = []
     if image_data:
-        content.append(
-            {
-                "type": "image",
-                "source": {
-                    "type": "base64",
-                    "media_type": image_type,
-                    "data": image_data,
-                },
-            }
-        )
+        content.append(_image_block(image_type, image_data))
+    elif IMAGE_HISTORY_MODE == "transcribe" and _user_asked_for_image_again(user_text):
+        # Re-attach the original upload for an explicit "look at the image again"
+        image_ref = _latest_image_ref(conversations.get(session_id))
+        if image_ref:
+            content.append(image_ref)
     content.append({"type": "text", "text": prefixed_text})
 
     # Add user message to history
-    conversations[session_id].append({"role": "user", "content": content})
+    conversations.append(session_id, _history_message("user", content))
 
     # Trim if needed
-    conversations[session_id] = trim_conversation(conversations[session_id])
-
     try:
-        response = client.messages.create(
-            model=MODEL,
-            max_tokens=MAX_TOKENS,
-            system=get_system_prompt(),
-            messages=conversations[session_id],
-        )
+        history = conversations.get(session_id)
+        messages = trim_conversation(history)
+        if len(messages) != len(history):
+            conversations.replace(session_id, messages)
+    except Exception as e:
+        # Remove the user message so the next turn does not follow it with another
+        conversations.pop(session_id)
+        return jsonify({"error": str(e)}), 500
+    timer.mark("history", since=history_started)
 
-        assistant_text = response.content[0].text
+    try:
+        cache_key = cached = None
+        if len(history) == 1:
+            with timer.span("cache"):
+                cache_key = _response_cache_key(data, user_text, mode, image_data)
+                cached = response_cache.get(cache_key) if cache_key else None
+
+        if cached is not None:
+            assistant_text, usage = cached, {}
+        else:
+            with timer.span("prompt"):
+                system = _system_blocks()
+                upstream_messages = _request_messages(_resolve_image_refs(messages))
+
+            with timer.span("upstream"):
+                flight, started = _upstream_flight(system, upstream_messages, cache_key)
+                # Tokens and upstream latency belong to the request that started the call
+                g.coalesced = not started
+                assistant_text = "".join(flight.follow())
+
+            usage = {}
+            if started:
+                usage = g.usage = flight.result["usage"]
+            # Only complete answers; one cut off at max_tokens is not worth repeating
+            if cache_key and flight.result["stop_reason"] == "end_turn":
+                response_cache.put(cache_key, assistant_text)
 
         # Process Python code blocks and execute matplotlib plots
         allow_plots = plot_mode == "auto" or _user_asked_for_plot(user_text)
-        processed_text = process_response_with_plots(assistant_text, allow_plots=allow_plots)
+        with timer.span("plots"):
+            processed_text = process_response_with_plots(
+                assistant_text,
+                allow_plots=allow_plots,
+                inline=(plot_delivery == "inline") if plot_delivery else None,
+            )
 
         # Store assistant response (original text for conversation history)
-        conversations[session_id].append(
-            {"role": "assistant", "content": assistant_text}
-        )
+        with timer.span("persist"):
+            conversations.append(session_id, _history_message("assistant", assistant_text))
 
-        return jsonify({"response": processed_text, "session_id": session_id})
+        return jsonify({
+            "response": processed_text,
+            "session_id": session_id,
+            "usage": usage,
+            "cached": cached is not None,
+        })
 
     except Exception as e:
         # Remove the failed user message from history
-        conversations[session_id].pop()
+        conversations.pop(session_id)
         return jsonify({"error": str(e)}), 500
 
 
 @app.route("/api/chat-stream", methods=["POST"])
 @require_auth
 def chat_stream():
+    timer = _request_timer()
     data = request.json
 
     user_text = data.get("message", "").strip()
@@ -383,14 +1151,24 @@ def chat_stream():
     explain_action = data.get("explain_action")  # "deeper", "differently", "verify", "review"
     original_concept = data.get("original_concept")  # Track concept being explained
     plot_mode = data.get("plot_mode", "on_demand")  # "auto" or "on_demand"
+    plot_delivery = data.get("plot_delivery")  # "url" or "inline"; defaults to PLOT_DELIVERY
     show_steps = data.get("show_steps", True)
     explain_style = data.get("explain_style", "intuition")
     exam_answer = data.get("exam_answer", False)
+    g.mode = mode if mode in METRICS_MODES else "other"
 
     # Need either text or image
     if not user_text and not image_data:
         return jsonify({"error": "Please provide a message or image."}), 400
 
+    # Normalize the upload before it is stored or sent upstream
+    if image_data:
+        try:
+            with timer.span("image"):
+                image_data, image_type = _normalize_upload(image_data, image_type)
+        except ImageRejected as e:
+            return jsonify({"error": str(e)}), 400
+
     # Default text when only an image is sent
     if not user_text and image_data:
         user_text = (
@@ -398,98 +1176,132 @@ def chat_stream():
             "understand how to approach it."
         )
 
-    # Apply mode instruction (or follow-up instruction for Explain mode)
-    if mode == "exam" and exam_answer:
-        prefixed_text = (
-            "Exam grading mode. The student is answering the previous exam problem. "
-            "Grade strictly and briefly: state whether it is correct, list 1–2 key errors "
-            "or confirmations, and give the final answer. Keep a formal, time-pressured tone.\n\n"
-            f"Student answer: {user_text}"
-        )
-    elif mode == "explain" and explain_action:
-        prefixed_text = get_explain_followup_instruction(
-            explain_action, user_text, original_concept
-        )
-    else:
-        prefixed_text = get_mode_instruction(mode, user_text)
-        if mode == "solve" and not show_steps:
-            prefixed_text += "\n\nKeep the response concise. Do not show step-by-step work; provide only the final answer with a brief justification."
-        if mode == "solve":
-            prefixed_text += "\n\nInclude a 1–2 sentence real-world application."
-    if mode == "explain":
-        if explain_style == "equation":
-            prefixed_text += "\n\nStart with the formal definition/equation first, then provide intuition and examples."
-        else:
-            prefixed_text += "\n\nStart with intuition first, then introduce formal definitions/equations."
-    if mode in ("solve", "explain"):
-        prefixed_text += "\n\nEnd with a short 'Key takeaway' section (1–2 sentences)."
-
-    # If an image is included, ask for a clean transcription first
-    if image_data:
-        prefixed_text += "\n\nIf an image is provided, first transcribe the problem clearly before solving."
+    prefixed_text = _user_prompt(
+        mode, user_text, show_steps=show_steps, explain_style=explain_style, explain_action=explain_action,
+        original_concept=original_concept, exam_answer=exam_answer, has_image=bool(image_data),
+    )
 
     # Session management
-    if not session_id or session_id not in conversations:
-        session_id = str(uuid.uuid4())
-        conversations[session_id] = []
+    history_started = time.perf_counter()
+    if not session_id or not conversations.exists(session_id):
+        session_id = conversations.create()
 
     # Build content blocks for Claude API
     content = []
     if image_data:
-        content.append(
-            {
-                "type": "image",
-                "source": {
-                    "type": "base64",
-                    "media_type": image_type,
-                    "data": image_data,
-                },
-            }
-        )
+        content.append(_image_block(image_type, image_data))
+    elif IMAGE_HISTORY_MODE == "transcribe" and _user_asked_for_image_again(user_text):
+        # Re-attach the original upload for an explicit "look at the image again"
+        image_ref = _latest_image_ref(conversations.get(session_id))
+        if image_ref:
+            content.append(image_ref)
     content.append({"type": "text", "text": prefixed_text})
 
     # Add user message to history
-    conversations[session_id].append({"role": "user", "content": content})
+    conversations.append(session_id, _history_message("user", content))
 
     # Trim if needed
-    conversations[session_id] = trim_conversation(conversations[session_id])
+    try:
+        history = conversations.get(session_id)
+        messages = trim_conversation(history)
+        if len(messages) != len(history):
+            conversations.replace(session_id, messages)
+    except Exception as e:
+        # Remove the user message so the next turn does not follow it with another
+        conversations.pop(session_id)
+        return jsonify({"error": str(e)}), 500
+    timer.mark("history", since=history_started)
+
+    allow_plots = plot_mode == "auto" or _user_asked_for_plot(user_text)
+    inline = (plot_delivery or PLOT_DELIVERY) == "inline"
+
+    def plot_event(index, png):
+        src = _plot_image_src(png, inline) if png else None
+        return f"data: {json.dumps({'type': 'plot', 'index': index, 'src': src})}\n\n"
+
+    def upstream_text(final, cache_key):
+        """Yield the answer's text chunks from the Messages API; fills ``final`` at the end."""
+        with timer.span("prompt"):
+            system = _system_blocks()
+            upstream_messages = _request_messages(_resolve_image_refs(messages))
+
+        upstream_started = time.perf_counter()
+        first_token_at = None
+        # A request joining a generation mid-stream first receives the text so far
+        flight, started = _upstream_flight(system, upstream_messages, cache_key)
+        g.coalesced = not started
+        with closing(flight.follow()) as chunks:
+            for text in chunks:
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                    timer.mark("ttft", since=upstream_started)
+                yield text
+        timer.mark("generate", since=first_token_at or upstream_started)
+        if started:
+            final["usage"] = g.usage = flight.result["usage"]
+        final["stop_reason"] = flight.result["stop_reason"]
 
     def generate():
         assistant_text_parts = []
+        plot_blocks = PlotBlockStream()
+        final = {"usage": {}, "stop_reason": None}
         try:
-            with client.messages.stream(
-                model=MODEL,
-                max_tokens=MAX_TOKENS,
-                system=get_system_prompt(),
-                messages=conversations[session_id],
-            ) as stream:
-                for text in stream.text_stream:
-                    if not text:
-                        continue
-                    assistant_text_parts.append(text)
-                    payload = {"type": "delta", "text": text}
-                    yield f"data: {json.dumps(payload)}\n\n"
+            cache_key = cached = None
+            if len(history) == 1:
+                with timer.span("cache"):
+                    cache_key = _response_cache_key(data, user_text, mode, image_data)
+                    cached = response_cache.get(cache_key) if cache_key else None
+            # A cached answer is replayed through the same deltas and plot events
+            text_chunks = upstream_text(final, cache_key) if cached is None else replay_chunks(cached)
+
+            for text in text_chunks:
+                assistant_text_parts.append(text)
+                payload = {"type": "delta", "text": text}
+                yield f"data: {json.dumps(payload)}\n\n"
+
+                # Start rendering plot blocks as soon as their fence closes
+                if allow_plots:
+                    plot_blocks.feed(text)
+                    for index, png in plot_blocks.completed():
+                        yield plot_event(index, png)
+
+            plots_started = time.perf_counter()
+            for index, png in plot_blocks.drain(PLOT_RESPONSE_DEADLINE):
+                yield plot_event(index, png)
 
             assistant_text = "".join(assistant_text_parts)
-            allow_plots = plot_mode == "auto" or _user_asked_for_plot(user_text)
-            processed_text = process_response_with_plots(assistant_text, allow_plots=allow_plots)
-
-            conversations[session_id].append(
-                {"role": "assistant", "content": assistant_text}
+            if cache_key and final["stop_reason"] == "end_turn":
+                response_cache.put(cache_key, assistant_text)
+            processed_text = process_response_with_plots(
+                assistant_text,
+                allow_plots=allow_plots,
+                inline=inline,
+                plot_futures=plot_blocks.futures,
+                plot_timeout=0,
             )
+            # Only the wait after the text ends; blocks rendered mid-stream overlap generation
+            timer.mark("plots", since=plots_started)
+
+            with timer.span("persist"):
+                conversations.append(session_id, _history_message("assistant", assistant_text))
 
             done_payload = {
                 "type": "done",
                 "response": processed_text,
                 "session_id": session_id,
+                "usage": final["usage"],
+                "cached": cached is not None,
             }
             yield f"data: {json.dumps(done_payload)}\n\n"
         except Exception as e:
-            if conversations.get(session_id):
-                conversations[session_id].pop()
+            conversations.pop(session_id)
             error_payload = {"type": "error", "error": str(e)}
             yield f"data: {json.dumps(error_payload)}\n\n"
 
+        if SERVER_TIMING:
+            timing_payload = {"type": "timing", "timing": timer.as_dict()}
+            yield f"data: {json.dumps(timing_payload)}\n\n"
+
     return Response(
         stream_with_context(generate()),
         mimetype="text/event-stream",
@@ -497,14 +1309,121 @@ def chat_stream():
     )
 
 
+@app.route("/api/chat-batch", methods=["POST"])
+@require_auth
+def chat_batch():
+    """
+    Answer a list of problems in parallel on the bounded batch pool, streaming
+    one NDJSON line per problem as soon as it finishes (in completion order,
+    tagged with its index). With "batch_api": true the problems are queued on
+    the Message Batches API instead and collected from /api/chat-batch/<id>.
+    """
+    data = request.json or {}
+    problems = data.get("problems")
+    mode = data.get("mode", "solve")
+    g.mode = mode if mode in METRICS_MODES else "other"
+
+    if not isinstance(problems, list) or not problems:
+        return jsonify({"error": "Please provide a list of problems."}), 400
+    if len(problems) > BATCH_MAX_ITEMS:
+        return jsonify({"error": f"A batch can hold at most {BATCH_MAX_ITEMS} problems."}), 400
+
+    options = {
+        "show_steps": bool(data.get("show_steps", True)),
+        "explain_style": data.get("explain_style", "intuition"),
+        "plot_mode": data.get("plot_mode", "on_demand"),
+    }
+    inline = (data.get("plot_delivery") or PLOT_DELIVERY) == "inline"
+    errors = _batch_problem_errors(problems)
+
+    try:
+        system = _system_blocks()
+        if data.get("batch_api"):
+            return _submit_message_batch(problems, mode, options, system, errors)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    executor = _get_batch_executor()
+    futures = {
+        executor.submit(_solve_batch_item, problem.strip(), mode, options, inline, system): index
+        for index, problem in enumerate(problems)
+        if index not in errors
+    }
+    return Response(
+        stream_with_context(_stream_batch_results(futures, len(problems), errors)),
+        mimetype="application/x-ndjson",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+@app.route("/api/chat-batch/<batch_id>", methods=["GET"])
+@require_auth
+def chat_batch_results(batch_id):
+    """
+    Status of a Message Batches API job; once it has ended, its results as
+    NDJSON in the same format as /api/chat-batch, with plots rendered now.
+    """
+    try:
+        batch = client.messages.batches.retrieve(batch_id)
+        if batch.processing_status != "ended":
+            return jsonify({
+                "batch_id": batch.id,
+                "status": batch.processing_status,
+                "request_counts": batch.request_counts.model_dump(),
+            })
+        items = list(client.messages.batches.results(batch_id))
+    except NotFoundError:
+        return jsonify({"error": "Batch not found."}), 404
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    owner = _batch_owner_tag(request.user_id)
+    if not items or any(item.custom_id.rsplit("-", 1)[-1] != owner for item in items):
+        return jsonify({"error": "Batch not found."}), 404
+
+    inline = (request.args.get("plot_delivery") or PLOT_DELIVERY) == "inline"
+    executor = _get_batch_executor()
+    futures = {
+        executor.submit(_finish_batch_result, item, inline): int(item.custom_id.split("-")[0])
+        for item in items
+    }
+    return Response(
+        stream_with_context(_stream_batch_results(futures, len(items), {})),
+        mimetype="application/x-ndjson",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+@app.route("/api/plots/<digest>", methods=["GET"])
+def get_plot(digest):
+    # No auth: <img> tags cannot send a bearer token, and the URL is an unguessable content hash
+    if not _PLOT_DIGEST_RE.match(digest):
+        return jsonify({"error": "Plot not found."}), 404
+    png = plot_store.get(digest)
+    if png is None:
+        return jsonify({"error": "Plot not found."}), 404
+    response = Response(png, mimetype="image/png")
+    response.set_etag(digest)
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response.make_conditional(request)
+
+
 @app.route("/api/new-session", methods=["POST"])
 @require_auth
 def new_session():
-    session_id = str(uuid.uuid4())
-    conversations[session_id] = []
+    session_id = conversations.create()
     return jsonify({"session_id": session_id})
 
 
+@app.route("/api/metrics", methods=["GET"])
+def get_metrics():
+    if METRICS_TOKEN and not hmac.compare_digest(
+        request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"
+    ):
+        return _unauthorized()
+    return Response(registry.render(), content_type=metrics.CONTENT_TYPE)
+
+
 @app.route("/api/health", methods=["GET"])
 def health():
     api_key = os.environ.get("ANTHROPIC_API_KEY")
@@ -515,13 +1434,31 @@ def health():
             ),
             500,
         )
-    return jsonify({"status": "ok", "model": MODEL})
+    return jsonify({
+        "status": "ok",
+        "model": MODEL,
+        "plot_cache": plot_cache.stats(),
+        "sessions": conversations.stats(),
+        "images": image_stats(),
+        "auth": token_cache.stats(),
+        "response_cache": response_cache.stats(),
+        "coalescing": upstream_flights.stats(),
+    })
 
 
 # Allow Flask to work behind ngrok proxy
 from werkzeug.middleware.proxy_fix import ProxyFix
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 
+_warm_plot_pool()
+_prefetch_signing_certs()
+
+# Build the system prompt once at start-up instead of on the first request
+try:
+    get_compiled_prompt()
+except OSError as e:
+    print(f"System prompt not compiled at start-up: {e}")
+
 
 if __name__ == "__main__":
     print("Starting NexMath...")
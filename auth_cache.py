@@ -0,0 +1,100 @@
+"""
+Cache of verified Firebase ID tokens.
+
+Verifying an ID token checks its RS256 signature against Google's signing
+certificates, which costs CPU on every request and occasionally a certificate
+refresh. The client reuses one token for up to an hour, so the decoded claims
+are cached under a SHA-256 of the token until the token's own ``exp`` and
+later requests skip verification. Tokens that fail verification are never
+cached. Entries are bounded and evicted least recently used first.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+class VerifiedTokenCache:
+    """
+    Bounded LRU of decoded token claims.
+
+    ``verify`` is the real verifier (e.g. ``firebase_auth.verify_id_token``);
+    it is only called on a miss. ``leeway`` drops entries that many seconds
+    before ``exp`` so a token is never accepted after it has expired.
+    """
+
+    def __init__(self, verify, max_entries=10000, leeway=30):
+        self._verify = verify
+        self.max_entries = max(1, max_entries)
+        self.leeway = leeway
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self.expirations = 0
+        self._verify_count = 0
+        self._verify_seconds = 0.0
+        self._verify_max = 0.0
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def verify(self, token):
+        """Return decoded claims for ``token``, verifying it only on a cache miss."""
+        key = self._key(token)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, claims = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return claims
+                del self._entries[key]
+                self.expirations += 1
+            self.misses += 1
+
+        started = time.perf_counter()
+        try:
+            claims = self._verify(token)
+        except Exception:
+            with self._lock:
+                self.failures += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self._verify_count += 1
+                self._verify_seconds += elapsed
+                self._verify_max = max(self._verify_max, elapsed)
+
+        expires_at = float(claims.get("exp", 0)) - self.leeway
+        if expires_at > time.time():
+            with self._lock:
+                self._entries[key] = (expires_at, claims)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return claims
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "failures": self.failures,
+                "expirations": self.expirations,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "verifications": self._verify_count,
+                "verify_ms_avg": round(self._verify_seconds * 1000 / self._verify_count, 2) if self._verify_count else 0.0,
+                "verify_ms_max": round(self._verify_max * 1000, 2),
+            }
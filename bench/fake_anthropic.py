@@ -0,0 +1,218 @@
+"""
+Local stand-in for the Anthropic Messages API, for load tests.
+
+Serves POST /v1/messages for both plain and streaming (SSE) requests. Replies
+come from a corpus of canned answers. A streamed reply starts after
+``--ttft`` seconds and then arrives at ``--tokens-per-sec``, at about four
+characters per token. Non-streaming replies wait for the same total time.
+Point the app at it with ANTHROPIC_BASE_URL=http://127.0.0.1:<port>; any API
+key is accepted.
+
+    python bench/fake_anthropic.py --port 8788 --ttft 0.6 --tokens-per-sec 80 --corpus mixed
+
+Corpora: "plain" (text and LaTeX only), "plots" (every answer has a
+matplotlib block), "mixed" (half and half), or a path to a JSON list of
+answer strings.
+"""
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PLAIN_ANSWERS = [
+    "To differentiate $f(x) = x^3 \\sin x$, use the product rule: "
+    "$f'(x) = 3x^2 \\sin x + x^3 \\cos x$.\n\n"
+    "**Key takeaway:** differentiate each factor in turn and add the two products.",
+    "The integral $\\int_0^1 x e^{x^2} dx$ yields to the substitution $u = x^2$, $du = 2x\\,dx$:\n\n"
+    "$$\\int_0^1 x e^{x^2} dx = \\frac{1}{2}\\int_0^1 e^u du = \\frac{e - 1}{2}.$$\n\n"
+    "**Key takeaway:** look for a function whose derivative is also in the integrand.",
+    "A limit like $\\lim_{x \\to 0} \\frac{\\sin x}{x}$ is an indeterminate form $0/0$. "
+    "By L'Hôpital's rule it equals $\\lim_{x \\to 0} \\cos x = 1$. "
+    "Geometrically, near zero the arc and its chord have almost the same length.\n\n"
+    "**Key takeaway:** $\\sin x \\approx x$ for small $x$.",
+]
+
+PLOT_ANSWERS = [
+    "Here is $f(x) = x^2$ together with its tangent line at $x = 1$, $y = 2x - 1$:\n\n"
+    "```python\nimport numpy as np\nimport matplotlib.pyplot as plt\n\n"
+    "x = np.linspace(-2, 3, 200)\nplt.plot(x, x**2, label='f(x) = x^2')\n"
+    "plt.plot(x, 2*x - 1, '--', label='tangent at x = 1')\nplt.scatter([1], [1], color='red')\n"
+    "plt.legend()\nplt.grid(True)\nplt.title('Tangent line')\n```\n\n"
+    "The tangent touches the curve at $(1, 1)$ and its slope is $f'(1) = 2$.",
+    "The area under $\\sin x$ on $[0, \\pi]$ is $\\int_0^\\pi \\sin x\\,dx = 2$:\n\n"
+    "```python\nimport numpy as np\nimport matplotlib.pyplot as plt\n\n"
+    "x = np.linspace(0, np.pi, 200)\nplt.plot(x, np.sin(x))\n"
+    "plt.fill_between(x, np.sin(x), alpha=0.3)\nplt.title('Area under sin(x)')\n```\n\n"
+    "**Key takeaway:** a definite integral measures signed area.",
+    "Riemann sums approach the integral as the rectangles get narrower:\n\n"
+    "```python\nimport numpy as np\nimport matplotlib.pyplot as plt\n\n"
+    "fig, axes = plt.subplots(1, 2, figsize=(8, 3))\nx = np.linspace(0, 2, 200)\n"
+    "for ax, n in zip(axes, (4, 16)):\n    xs = np.linspace(0, 2, n, endpoint=False)\n"
+    "    ax.bar(xs, xs**2, width=2 / n, align='edge', alpha=0.4)\n    ax.plot(x, x**2)\n"
+    "    ax.set_title(f'n = {n}')\n```\n\n"
+    "With $n = 16$ the sum is already close to $\\int_0^2 x^2 dx = 8/3$.",
+]
+
+
+def load_corpus(name):
+    if name == "plain":
+        return list(PLAIN_ANSWERS)
+    if name == "plots":
+        return list(PLOT_ANSWERS)
+    if name == "mixed":
+        return [a for pair in itertools.zip_longest(PLAIN_ANSWERS, PLOT_ANSWERS) for a in pair if a]
+    with open(name) as f:
+        answers = json.load(f)
+    if not answers or not all(isinstance(a, str) for a in answers):
+        raise SystemExit(f"{name} must be a JSON list of answer strings")
+    return answers
+
+
+def _tokens(text):
+    """Split an answer into ~4-character chunks, the way deltas arrive upstream."""
+    return [text[i:i + 4] for i in range(0, len(text), 4)]
+
+
+class FakeMessagesHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "fake-anthropic/1.0"
+    # Set by serve()
+    corpus = PLAIN_ANSWERS
+    ttft = 0.5
+    tokens_per_sec = 80.0
+    rng = random.Random(0)
+    rng_lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def _choose(self):
+        with self.rng_lock:
+            return self.rng.choice(self.corpus)
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if not self.path.startswith("/v1/messages"):
+            self._send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": self.path}})
+            return
+        raw = self.rfile.read(int(self.headers.get("content-length", 0)))
+        try:
+            body = json.loads(raw)
+        except ValueError:
+            self._send_json(400, {"type": "error", "error": {"type": "invalid_request_error", "message": "bad JSON"}})
+            return
+
+        answer = self._choose()
+        tokens = _tokens(answer)
+        message = {
+            "id": f"msg_fake_{uuid.uuid4().hex[:12]}",
+            "type": "message",
+            "role": "assistant",
+            "model": body.get("model", "fake"),
+            "stop_reason": None,
+            "stop_sequence": None,
+            "usage": {"input_tokens": len(raw) // 4, "output_tokens": 1},
+        }
+        if body.get("stream"):
+            self._stream(message, tokens)
+        else:
+            time.sleep(self.ttft + len(tokens) / self.tokens_per_sec)
+            message.update(
+                content=[{"type": "text", "text": answer}],
+                stop_reason="end_turn",
+                usage={**message["usage"], "output_tokens": len(tokens)},
+            )
+            self._send_json(200, message)
+
+    def _chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _event(self, name, payload):
+        self._chunk(f"event: {name}\ndata: {json.dumps(payload)}\n\n".encode("utf-8"))
+
+    def _stream(self, message, tokens):
+        self.send_response(200)
+        self.send_header("content-type", "text/event-stream")
+        self.send_header("cache-control", "no-cache")
+        self.send_header("transfer-encoding", "chunked")
+        self.end_headers()
+        try:
+            self._event("message_start", {"type": "message_start", "message": {**message, "content": []}})
+            time.sleep(self.ttft)
+            self._event("content_block_start", {
+                "type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""},
+            })
+            started = time.monotonic()
+            for index, token in enumerate(tokens):
+                # Schedule against the start time so sleeps do not accumulate drift
+                delay = started + index / self.tokens_per_sec - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                self._event("content_block_delta", {
+                    "type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": token},
+                })
+            self._event("content_block_stop", {"type": "content_block_stop", "index": 0})
+            self._event("message_delta", {
+                "type": "message_delta",
+                "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                "usage": {"output_tokens": len(tokens)},
+            })
+            self._event("message_stop", {"type": "message_stop"})
+            self._chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            # The app closed the stream early (client went away or cut off at its deadline)
+            self.close_connection = True
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # Hundreds of simulated students connect at once
+    request_queue_size = 1024
+
+
+def serve(port=0, ttft=0.5, tokens_per_sec=80.0, corpus="mixed", seed=0):
+    """Start the fake API on a background thread; returns the server (``server.server_address``)."""
+    handler = type("Handler", (FakeMessagesHandler,), {
+        "corpus": load_corpus(corpus),
+        "ttft": ttft,
+        "tokens_per_sec": tokens_per_sec,
+        "rng": random.Random(seed),
+        "rng_lock": threading.Lock(),
+    })
+    server = _Server(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--port", type=int, default=8788)
+    parser.add_argument("--ttft", type=float, default=0.5, help="seconds before the first token")
+    parser.add_argument("--tokens-per-sec", type=float, default=80.0)
+    parser.add_argument("--corpus", default="mixed", help="plain, plots, mixed or a JSON file")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server = serve(args.port, args.ttft, args.tokens_per_sec, args.corpus, args.seed)
+    print(f"Fake Messages API on http://127.0.0.1:{server.server_address[1]} "
+          f"(ttft {args.ttft}s, {args.tokens_per_sec} tokens/s, corpus {args.corpus})", flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,331 @@
+"""
+Offline load test for /api/chat and /api/chat-stream.
+
+Starts the fake Messages API (bench/fake_anthropic.py) and the app under
+gunicorn, both on local ports. It then drives N concurrent simulated
+students, each opening a session and sending a number of turns. No API
+credits or Firebase project are needed: the app gets
+ANTHROPIC_BASE_URL pointed at the fake, and AUTH_BYPASS_TOKEN so the
+students skip Firebase.
+
+Reported: throughput, p50/p95/p99 request latency, time to first token
+(streaming), plot overhead (the "plots" stage from Server-Timing / the
+timing event) and the error count.
+
+    python bench/load_test.py --students 50 --turns 3
+    python bench/load_test.py --endpoint chat --worker-class gthread --workers 2 --env SESSION_BACKEND=sqlite
+    python bench/load_test.py --corpus plots --plot-mode auto --env PLOT_CACHE_MB=0
+    python bench/load_test.py --url http://127.0.0.1:8080 --token "$AUTH_BYPASS_TOKEN"   # an already running app
+
+Every --env KEY=VALUE is passed to the app, so worker models and caching
+options can be compared run against run. --json writes the summary for
+later comparison.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import secrets
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.join(REPO_DIR, "bench")
+
+QUESTIONS = {
+    "solve": ["Differentiate x^3 sin(x).", "Integrate x e^{x^2} from 0 to 1.", "Find lim sin(x)/x as x -> 0."],
+    "explain": ["Explain the chain rule.", "What does a definite integral measure?", "Why does L'Hopital's rule work?"],
+    "quiz": ["Quiz me on derivatives.", "Give me a related rates problem."],
+    "exam": ["Give me an exam question on integration by parts."],
+}
+PLOT_QUESTIONS = ["Plot x^2 with its tangent at x = 1.", "Graph the area under sin(x) on [0, pi]."]
+_TIMING_RE = re.compile(r"(\w+);dur=([\d.]+)")
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_for(url, timeout=60, proc=None):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc is not None and proc.poll() is not None:
+            raise RuntimeError(f"{proc.args[0]} exited with {proc.returncode}")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def _prepare_app_dir(scratch):
+    """Copy the app so a placeholder system prompt can be added when the checkout has none."""
+    app_dir = os.path.join(scratch, "app")
+    shutil.copytree(REPO_DIR, app_dir, ignore=shutil.ignore_patterns(
+        ".git", "functions", "bench", "__pycache__", "venv", ".venv", "*.db"))
+    prompt = os.path.join(app_dir, "CLAUDE.md")
+    if not os.path.exists(prompt):
+        with open(prompt, "w") as f:
+            f.write("# NexMath load-test placeholder prompt\n")
+    rules = os.path.join(app_dir, ".claude", "rules")
+    os.makedirs(rules, exist_ok=True)
+    for name in ("teaching-methodology.md", "problem-solving.md", "common-mistakes.md"):
+        path = os.path.join(rules, name)
+        if not os.path.exists(path):
+            shutil.copy(os.path.join(REPO_DIR, "functions", "rules", name), path)
+    return app_dir
+
+
+def _server_timing(header):
+    return {name: float(ms) for name, ms in _TIMING_RE.findall(header or "")}
+
+
+class Student:
+    """One simulated student: a session and ``turns`` sequential questions."""
+
+    def __init__(self, index, args, base_url, token, results, lock):
+        self.rng = random.Random(args.seed + index)
+        self.args = args
+        self.base_url = base_url
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self.results = results
+        self.lock = lock
+
+    def _question(self):
+        mode = self.rng.choice(self.args.modes)
+        if self.args.corpus == "plots" or (self.args.corpus == "mixed" and self.rng.random() < 0.5):
+            return mode, self.rng.choice(PLOT_QUESTIONS)
+        return mode, self.rng.choice(QUESTIONS.get(mode, QUESTIONS["solve"]))
+
+    def run(self):
+        timeout = httpx.Timeout(self.args.request_timeout, connect=10)
+        with httpx.Client(base_url=self.base_url, headers=self.headers, timeout=timeout) as client:
+            session_id = None
+            try:
+                session_id = client.post("/api/new-session").json().get("session_id")
+            except (httpx.HTTPError, ValueError) as e:
+                self._record({"error": f"new-session: {e}"})
+                return
+            for _ in range(self.args.turns):
+                mode, question = self._question()
+                payload = {
+                    "message": question, "mode": mode, "session_id": session_id,
+                    "plot_mode": self.args.plot_mode, "plot_delivery": "url",
+                }
+                if self.args.endpoint == "stream":
+                    result = self._stream(client, payload)
+                else:
+                    result = self._chat(client, payload)
+                result["mode"] = mode
+                self._record(result)
+                if self.args.think:
+                    time.sleep(self.rng.uniform(0, 2 * self.args.think))
+
+    def _record(self, result):
+        with self.lock:
+            self.results.append(result)
+
+    def _chat(self, client, payload):
+        started = time.perf_counter()
+        try:
+            response = client.post("/api/chat", json=payload)
+        except httpx.HTTPError as e:
+            return {"error": repr(e)}
+        latency = time.perf_counter() - started
+        if response.status_code != 200:
+            return {"error": f"HTTP {response.status_code}", "latency": latency}
+        timing = _server_timing(response.headers.get("server-timing"))
+        return {"latency": latency, "plots_ms": timing.get("plots"), "server": timing}
+
+    def _stream(self, client, payload):
+        started = time.perf_counter()
+        ttft = None
+        timing = {}
+        plots = 0
+        outcome = None
+        try:
+            with client.stream("POST", "/api/chat-stream", json=payload) as response:
+                if response.status_code != 200:
+                    return {"error": f"HTTP {response.status_code}"}
+                for line in response.iter_lines():
+                    if not line.startswith("data: "):
+                        continue
+                    event = json.loads(line[6:])
+                    kind = event.get("type")
+                    if kind == "delta" and ttft is None:
+                        ttft = time.perf_counter() - started
+                    elif kind == "plot":
+                        plots += 1
+                    elif kind in ("done", "error"):
+                        outcome = event
+                    elif kind == "timing":
+                        timing = event.get("timing", {})
+        except httpx.HTTPError as e:
+            return {"error": repr(e)}
+        latency = time.perf_counter() - started
+        if not outcome or outcome.get("type") == "error":
+            return {"error": (outcome or {}).get("error", "stream ended without done"), "latency": latency}
+        return {"latency": latency, "ttft": ttft, "plots_ms": timing.get("plots") if plots else None,
+                "plot_events": plots, "server": timing}
+
+
+def _percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def pick(q):
+        return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": values[-1],
+            "mean": statistics.fmean(values)}
+
+
+def summarize(results, elapsed):
+    ok = [r for r in results if "error" not in r]
+    errors = [r["error"] for r in results if "error" in r]
+    summary = {
+        "requests": len(results),
+        "ok": len(ok),
+        "errors": len(errors),
+        "elapsed_s": round(elapsed, 2),
+        "throughput_rps": round(len(ok) / elapsed, 2) if elapsed else 0.0,
+        "latency_s": _percentiles([r["latency"] for r in ok]),
+        "ttft_s": _percentiles([r["ttft"] for r in ok if r.get("ttft") is not None]),
+        "plots_ms": _percentiles([r["plots_ms"] for r in ok if r.get("plots_ms") is not None]),
+        "error_samples": sorted(set(errors))[:5],
+    }
+    by_mode = {}
+    for r in ok:
+        by_mode.setdefault(r["mode"], []).append(r["latency"])
+    summary["latency_by_mode_s"] = {mode: _percentiles(v) for mode, v in sorted(by_mode.items())}
+    return summary
+
+
+def _print_summary(summary, args):
+    def row(label, stats, unit, scale=1.0):
+        if not stats:
+            print(f"  {label:<16} n/a")
+            return
+        print(f"  {label:<16} p50 {stats['p50'] * scale:8.1f}  p95 {stats['p95'] * scale:8.1f}  "
+              f"p99 {stats['p99'] * scale:8.1f}  max {stats['max'] * scale:8.1f} {unit}")
+
+    print(f"\n{args.students} students x {args.turns} turns, endpoint {args.endpoint}, corpus {args.corpus}, "
+          f"worker {args.worker_class} x{args.workers}" + (f", env {' '.join(args.env)}" if args.env else ""))
+    print(f"  requests         {summary['ok']} ok, {summary['errors']} failed in {summary['elapsed_s']} s "
+          f"({summary['throughput_rps']} req/s)")
+    row("latency", summary["latency_s"], "ms", 1000)
+    row("ttft", summary["ttft_s"], "ms", 1000)
+    row("plot overhead", summary["plots_ms"], "ms")
+    for mode, stats in summary["latency_by_mode_s"].items():
+        row(f"  {mode}", stats, "ms", 1000)
+    for sample in summary["error_samples"]:
+        print(f"  error: {sample}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--students", type=int, default=20, help="concurrent simulated students")
+    parser.add_argument("--turns", type=int, default=3, help="questions per student")
+    parser.add_argument("--think", type=float, default=0.0, help="mean think time between turns (s)")
+    parser.add_argument("--endpoint", choices=("stream", "chat"), default="stream")
+    parser.add_argument("--modes", default="solve,explain,quiz,exam")
+    parser.add_argument("--plot-mode", choices=("on_demand", "auto"), default="on_demand")
+    parser.add_argument("--corpus", default="mixed", help="fake API corpus: plain, plots, mixed or a JSON file")
+    parser.add_argument("--ttft", type=float, default=0.5, help="fake API time to first token (s)")
+    parser.add_argument("--tokens-per-sec", type=float, default=80.0)
+    parser.add_argument("--worker-class", default="gevent", help="gunicorn worker class for the app")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra app environment")
+    parser.add_argument("--url", help="load an already running app instead of starting one")
+    parser.add_argument("--token", help="AUTH_BYPASS_TOKEN of the app given by --url")
+    parser.add_argument("--request-timeout", type=float, default=180.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the summary to this file")
+    args = parser.parse_args()
+    args.modes = [m for m in args.modes.split(",") if m]
+
+    procs = []
+    summary = None
+    scratch = tempfile.mkdtemp(prefix="nexmath-load-")
+    try:
+        if args.url:
+            base_url = args.url.rstrip("/")
+            token = args.token or os.environ.get("AUTH_BYPASS_TOKEN", "")
+        else:
+            api_port, app_port = _free_port(), _free_port()
+            procs.append(subprocess.Popen([
+                sys.executable, os.path.join(BENCH_DIR, "fake_anthropic.py"), "--port", str(api_port),
+                "--ttft", str(args.ttft), "--tokens-per-sec", str(args.tokens_per_sec),
+                "--corpus", args.corpus, "--seed", str(args.seed),
+            ], stdout=subprocess.DEVNULL))
+
+            token = secrets.token_urlsafe(24)
+            env = {
+                **os.environ,
+                "PORT": str(app_port),
+                "GUNICORN_WORKER_CLASS": args.worker_class,
+                "WEB_CONCURRENCY": str(args.workers),
+                "ANTHROPIC_API_KEY": "load-test",
+                "ANTHROPIC_BASE_URL": f"http://127.0.0.1:{api_port}",
+                "AUTH_BYPASS_TOKEN": token,
+                "SESSION_DB_PATH": os.path.join(scratch, "sessions.db"),
+                "PLOT_STORE_DIR": os.path.join(scratch, "plots"),
+            }
+            for item in args.env:
+                key, _, value = item.partition("=")
+                env[key] = value
+            log = open(os.path.join(scratch, "app.log"), "w")
+            procs.append(subprocess.Popen(
+                [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "app:app"],
+                cwd=_prepare_app_dir(scratch), env=env, stdout=log, stderr=subprocess.STDOUT,
+            ))
+            base_url = f"http://127.0.0.1:{app_port}"
+            _wait_for(f"http://127.0.0.1:{api_port}/", proc=procs[0])
+            _wait_for(f"{base_url}/api/health", proc=procs[1])
+
+        results, lock = [], threading.Lock()
+        students = [Student(i, args, base_url, token, results, lock) for i in range(args.students)]
+        threads = [threading.Thread(target=s.run, daemon=True) for s in students]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        summary = summarize(results, time.perf_counter() - started)
+    finally:
+        for proc in reversed(procs):
+            proc.terminate()
+            try:
+                proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        if summary is None:
+            # The run failed; show the end of the app log
+            log_path = os.path.join(scratch, "app.log")
+            if os.path.exists(log_path):
+                with open(log_path) as f:
+                    print(f.read()[-3000:], file=sys.stderr)
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    _print_summary(summary, args)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "summary": summary}, f, indent=2)
+    return 1 if summary["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
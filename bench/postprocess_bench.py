@@ -0,0 +1,255 @@
+"""
+Micro-benchmark for the response post-processor.
+
+Times the shipped process_response_with_plots (app.py, or functions/main.py
+with --target functions) on each finished answer, minus the rendering itself:
+the plot worker pool is replaced by one that returns a fixed PNG, and blocks
+render one after another instead of on the plot executor. Everything else
+runs as deployed: the scan for fenced plot blocks (or a bare snippet),
+sanitizing, the plot cache lookup, the <img> src and the splice. Every answer
+in the corpus also runs through the regex implementation the scanner
+replaced. The two outputs must match exactly, and the script reports
+microseconds per answer and MB/s for each.
+
+    python bench/postprocess_bench.py
+    python bench/postprocess_bench.py --target functions
+    python bench/postprocess_bench.py --corpus captured.json --json postprocess.json
+    python bench/postprocess_bench.py --baseline postprocess.json --tolerance 0.25
+
+The built-in corpus holds the load-test answers (bench/fake_anthropic.py)
+plus long multi-section answers assembled from them. ``--corpus`` takes a
+JSON list of captured response strings instead. With --baseline the script
+exits 1 if any answer is more than ``tolerance`` slower than the saved
+figure. It also exits 1 if the two implementations ever disagree.
+"""
+import argparse
+import base64
+import importlib
+import json
+import os
+import re
+import sys
+import time
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_anthropic import PLAIN_ANSWERS, PLOT_ANSWERS  # noqa: E402
+
+_FAKE_PNG = b"\x89PNG\r\n\x1a\n" + bytes(256)
+
+
+def _image_html(src):
+    return f'''<div class="plot-container">
+<img src="{src}" alt="Plot" class="matplotlib-plot">
+</div>'''
+
+
+def _bare_image_html(src):
+    return (
+        f'<div class="plot-container">'
+        f'<img src="{src}" alt="Plot" class="matplotlib-plot">'
+        f'</div>'
+    )
+
+
+# --- Shipped implementation, with rendering stubbed -----------------------------
+
+class _FixedPool:
+    def render(self, code, dpi=100, timeout=None):
+        return _FAKE_PNG
+
+
+def load_postprocessor(target):
+    """
+    Import the module for ``target`` with rendering stubbed. Returns its
+    process_response_with_plots and the <img> src it gives every plot.
+    """
+    if target == "functions":
+        sys.path.insert(0, os.path.join(ROOT, "functions"))
+        module = importlib.import_module("main")
+        src = "data:image/png;base64," + base64.b64encode(_FAKE_PNG).decode("utf-8")
+    else:
+        sys.path.insert(0, ROOT)
+        module = importlib.import_module("app")
+        # Memory-only stores, so timing never touches the disk tiers
+        module.plot_store = module.PlotCache(max_bytes=64 * 1024 * 1024)
+        src = module._plot_image_src(_FAKE_PNG, module.PLOT_DELIVERY == "inline")
+    module.plot_cache = module.PlotCache(max_bytes=64 * 1024 * 1024)
+    module._get_plot_pool = _FixedPool
+
+    def render_in_order(codes, *args, **kwargs):
+        return [module.execute_python_code(code) for code in codes]
+
+    module._render_plot_blocks = render_in_order
+    return module.process_response_with_plots, src
+
+
+# --- Regex implementation it replaced, kept for comparison ----------------------
+
+def _legacy_sanitize(code):
+    def _sanitize_code(raw):
+        lines = raw.splitlines()
+        cleaned = []
+        code_like = re.compile(
+            r'^\s*(#|import |from |plt\.|np\.|matplotlib|sns\.|ax\.|fig\.|'
+            r'for |if |elif |else:|while |def |class |with |try:|except |return|'
+            r'pass|break|continue|[A-Za-z_][A-Za-z0-9_]*(\s*,\s*[A-Za-z_][A-Za-z0-9_]*)*\s*=|'
+            r'[A-Za-z_][A-Za-z0-9_]*\s*\(|[\]\)\}])'
+        )
+        for line in lines:
+            if "```" in line:
+                continue
+            if line.strip() == "":
+                cleaned.append(line)
+                continue
+            if code_like.search(line):
+                cleaned.append(line)
+            else:
+                cleaned.append("# " + line)
+        return "\n".join(cleaned)
+
+    return _sanitize_code(re.sub(r'^\s*plt\.show\(\)\s*$', '', code, flags=re.MULTILINE))
+
+
+def legacy_postprocess(text, src):
+    matches = list(re.finditer(r'```[^\n]*\r?\n(.*?)```', text, flags=re.DOTALL))
+    plot_matches = [m for m in matches if 'matplotlib' in m.group(1) or 'plt.' in m.group(1)]
+    for match in plot_matches:
+        _legacy_sanitize(match.group(1))
+
+    parts = []
+    pos = 0
+    for match in plot_matches:
+        parts.append(text[pos:match.start()])
+        parts.append(_image_html(src))
+        pos = match.end()
+    parts.append(text[pos:])
+    processed = "".join(parts)
+
+    if not plot_matches and ("matplotlib" in text or "plt." in text):
+        lines = text.splitlines()
+        start_idx = None
+        code_line_re = re.compile(
+            r'^\s*(#|import |from |plt\.|np\.|[A-Za-z_][A-Za-z0-9_]*\s*=|[A-Za-z_][A-Za-z0-9_]*\s*\()'
+        )
+        for i, line in enumerate(lines):
+            if re.search(r'^\s*(import matplotlib|from matplotlib|import numpy|import matplotlib\.pyplot)', line) or "plt." in line:
+                start_idx = i
+                break
+        if start_idx is not None:
+            end_idx = None
+            for i in range(start_idx, len(lines)):
+                if code_line_re.search(lines[i]) or lines[i].strip() == "":
+                    end_idx = i
+                elif end_idx is not None and i > end_idx + 1:
+                    break
+            if end_idx is not None:
+                _legacy_sanitize("\n".join(lines[start_idx:end_idx + 1]))
+                before = "\n".join(lines[:start_idx])
+                after = "\n".join(lines[end_idx + 1:])
+                return "\n".join([before, _bare_image_html(src), after]).strip()
+    return processed
+
+
+# --- Corpus and timing ---------------------------------------------------------
+
+_NUMERIC_ANSWER = (
+    "We can check the limit numerically before proving it:\n\n"
+    "```python\nimport math\nfor n in (10, 100, 1000):\n    print(n, (1 + 1/n) ** n)\n```\n\n"
+    "The values approach $e \\approx 2.71828$, as the proof below confirms.\n"
+)
+_BARE_ANSWER = (
+    "Paste this into a notebook to see the curve:\n\n"
+    "import numpy as np\nimport matplotlib.pyplot as plt\n"
+    "x = np.linspace(-3, 3, 200)\nplt.plot(x, np.exp(-x**2))\nplt.title('Gaussian')\n\n"
+    "Notice how quickly the tails vanish; that is why $\\int e^{-x^2}dx$ converges.\n"
+)
+
+
+def builtin_corpus():
+    corpus = {f"plain-{i}": a for i, a in enumerate(PLAIN_ANSWERS)}
+    corpus.update({f"plot-{i}": a for i, a in enumerate(PLOT_ANSWERS)})
+    corpus["numeric-code"] = _NUMERIC_ANSWER
+    corpus["bare-snippet"] = _BARE_ANSWER
+    sections = PLAIN_ANSWERS + [_NUMERIC_ANSWER]
+    # A long worked solution without plots, and one with a plot every few sections
+    corpus["long-plain"] = "\n\n".join(sections[i % len(sections)] for i in range(60))
+    corpus["long-plots"] = "\n\n".join(
+        PLOT_ANSWERS[i % len(PLOT_ANSWERS)] if i % 5 == 4 else sections[i % len(sections)] for i in range(60)
+    )
+    corpus["crlf-plots"] = corpus["plot-0"].replace("\n", "\r\n")
+    return corpus
+
+
+def _time(fn, text, repeat):
+    timer = timeit.Timer(lambda: fn(text))
+    loops, _ = timer.autorange()
+    best = min(timer.repeat(repeat=repeat, number=loops)) / loops
+    return best * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--target", choices=("app", "functions"), default="app",
+                        help="which process_response_with_plots to time")
+    parser.add_argument("--corpus", help="JSON list of response strings (default: built-in corpus)")
+    parser.add_argument("--repeat", type=int, default=5, help="timing repeats; the best one counts")
+    parser.add_argument("--json", help="write the per-answer timings to this file")
+    parser.add_argument("--baseline", help="compare against a file written by --json")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    if args.corpus:
+        with open(args.corpus) as f:
+            answers = json.load(f)
+        corpus = {f"answer-{i}": a for i, a in enumerate(answers) if isinstance(a, str)}
+    else:
+        corpus = builtin_corpus()
+
+    postprocess, src = load_postprocessor(args.target)
+    mismatches = [name for name, text in corpus.items() if postprocess(text) != legacy_postprocess(text, src)]
+    if mismatches:
+        print("Output differs from the regex implementation for: " + ", ".join(mismatches))
+        return 1
+
+    results = {}
+    started = time.perf_counter()
+    print(f"{'answer':<16}{'bytes':>9}{'shipped µs':>11}{'MB/s':>9}{'regex µs':>11}{'speedup':>9}")
+    for name, text in corpus.items():
+        size = len(text.encode("utf-8"))
+        current = _time(postprocess, text, args.repeat)
+        legacy = _time(lambda t: legacy_postprocess(t, src), text, args.repeat)
+        results[name] = {"bytes": size, "us": round(current, 2), "legacy_us": round(legacy, 2)}
+        print(f"{name:<16}{size:>9}{current:>11.1f}{size / current:>9.1f}{legacy:>11.1f}{legacy / current:>8.1f}x")
+    total_bytes = sum(r["bytes"] for r in results.values())
+    total_us = sum(r["us"] for r in results.values())
+    total_legacy = sum(r["legacy_us"] for r in results.values())
+    print(f"{'total':<16}{total_bytes:>9}{total_us:>11.1f}{total_bytes / total_us:>9.1f}"
+          f"{total_legacy:>11.1f}{total_legacy / total_us:>8.1f}x")
+    print(f"\n{len(results)} answers, outputs identical, {time.perf_counter() - started:.1f}s")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = []
+        for name, result in results.items():
+            before = baseline.get(name, {}).get("us")
+            if before and result["us"] > before * (1 + args.tolerance):
+                regressions.append(f"{name}: {before} -> {result['us']} µs")
+        if regressions:
+            print("\nRegressions beyond {:.0%}:".format(args.tolerance))
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print(f"\nNo regressions beyond {args.tolerance:.0%} of {args.baseline}.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
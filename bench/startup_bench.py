@@ -0,0 +1,360 @@
+"""
+Cold-start benchmark for the Cloud Function in functions/main.py.
+
+Every run starts a fresh interpreter, the way a new instance does, for one
+target at a time (FUNCTION_TARGET=health or chat) and records:
+
+- import_ms:          time to import main.py
+- first_response_ms:  interpreter start to the first complete response
+- wall_ms:            process spawn to that response, as seen from outside
+- an ``-X importtime`` breakdown of import self-time by top-level package
+
+Nothing leaves the machine. The functions directory is copied to a scratch
+directory, and a placeholder CLAUDE.md is added if the checkout has none. A
+throwaway service-account key lets the Firebase and Firestore clients be
+constructed without making any call. Firestore is then swapped for
+an in-memory stub, and the Anthropic API is a local fake server.
+
+    python bench/startup_bench.py                  # 5 runs per target
+    python bench/startup_bench.py --runs 10 --top 20 --json startup.json
+    python bench/startup_bench.py --baseline startup.json --tolerance 0.25
+
+With --baseline the script exits 1 if any median is more than ``tolerance``
+slower than the saved one, so it can gate a change locally or in CI.
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FUNCTIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "functions")
+TARGETS = ("health", "chat")
+_IMPORTTIME_RE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+# --- Child: runs inside the fresh interpreter --------------------------------
+
+class _Snapshot:
+    def __init__(self, data):
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+    def get(self, key):
+        return self._data[key]
+
+
+class _Query:
+    def __init__(self, collection, descending=False, after=None, limit=None):
+        self.collection = collection
+        self.descending = descending
+        self.after = after
+        self._limit = limit
+
+    def order_by(self, field, direction=None):
+        return _Query(self.collection, direction == "DESCENDING")
+
+    def start_after(self, values):
+        return _Query(self.collection, self.descending, values["seq"], self._limit)
+
+    def limit(self, count):
+        return _Query(self.collection, self.descending, self.after, count)
+
+    def stream(self):
+        docs = sorted(self.collection.docs.values(), key=lambda d: d["seq"], reverse=self.descending)
+        if self.after is not None:
+            docs = [d for d in docs if (d["seq"] < self.after if self.descending else d["seq"] > self.after)]
+        return [_Snapshot(d) for d in docs[:self._limit]]
+
+
+class _Collection:
+    def __init__(self):
+        self.docs = {}
+        self.children = {}
+
+    def document(self, doc_id):
+        return _Document(self, doc_id)
+
+    def order_by(self, field, direction=None):
+        return _Query(self).order_by(field, direction)
+
+
+class _Document:
+    def __init__(self, collection, doc_id):
+        self.collection_ref = collection
+        self.id = doc_id
+
+    def get(self, transaction=None):
+        return _Snapshot(self.collection_ref.docs.get(self.id))
+
+    def collection(self, name):
+        return self.collection_ref.children.setdefault((self.id, name), _Collection())
+
+
+class _Batch:
+    def __init__(self):
+        self.ops = []
+
+    def set(self, ref, data, merge=False):
+        self.ops.append((ref, data, merge))
+
+    def commit(self):
+        from firebase_admin import firestore
+        for ref, data, merge in self.ops:
+            current = dict(ref.collection_ref.docs.get(ref.id) or {}) if merge else {}
+            for key, value in data.items():
+                if value is firestore.DELETE_FIELD:
+                    current.pop(key, None)
+                elif isinstance(value, firestore.Increment):
+                    current[key] = current.get(key, 0) + value.value
+                else:
+                    current[key] = value
+            ref.collection_ref.docs[ref.id] = current
+
+
+class _Transaction(_Batch):
+    """A batch that firestore.transactional can drive; the fake never conflicts."""
+
+    _read_only = False
+    _max_attempts = 1
+    _id = None
+
+    def _clean_up(self):
+        self.ops = []
+
+    def _begin(self, retry_id=None):
+        pass
+
+    def _commit(self):
+        self.commit()
+
+    def _rollback(self):
+        self.ops = []
+
+
+class _FakeFirestore:
+    """Just enough of the Firestore client for conversation_store."""
+
+    def __init__(self):
+        self.root = _Collection()
+
+    def collection(self, name):
+        return self.root
+
+    def batch(self):
+        return _Batch()
+
+    def transaction(self):
+        return _Transaction()
+
+
+def _child(target):
+    started = time.perf_counter()
+    sys.path.insert(0, os.getcwd())
+    import main
+    imported = time.perf_counter()
+
+    from flask import Request
+    from werkzeug.test import EnvironBuilder
+
+    if target == "health":
+        builder = EnvironBuilder(method="GET", path="/")
+        response = main.health(builder.get_request(Request))
+    else:
+        main._FIRESTORE_DB = _FakeFirestore()
+        builder = EnvironBuilder(method="POST", path="/", json={"message": "Differentiate x^2.", "mode": "solve"})
+        response = main.chat(builder.get_request(Request))
+    finished = time.perf_counter()
+
+    heavy = ("anthropic", "httpx", "google.cloud.firestore", "PIL", "grpc")
+    print(json.dumps({
+        "status": response.status_code,
+        "import_ms": (imported - started) * 1000,
+        "first_response_ms": (finished - started) * 1000,
+        "loaded": sorted(name for name in heavy if name in sys.modules),
+    }))
+
+
+# --- Parent: stubs, runs and reporting ---------------------------------------
+
+class _FakeMessagesAPI(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("content-length", 0)))
+        body = json.dumps({
+            "id": "msg_bench", "type": "message", "role": "assistant", "model": "bench",
+            "content": [{"type": "text", "text": "The derivative of x^2 is 2x."}],
+            "stop_reason": "end_turn", "stop_sequence": None,
+            "usage": {"input_tokens": 10, "output_tokens": 10},
+        }).encode("utf-8")
+        self.send_response(200)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _write_service_account(path):
+    """A syntactically valid key that is never used to call Google."""
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    ).decode("ascii")
+    with open(path, "w") as f:
+        json.dump({
+            "type": "service_account", "project_id": "nexmath-bench", "private_key_id": "bench",
+            "private_key": pem, "client_email": "bench@nexmath-bench.iam.gserviceaccount.com",
+            "client_id": "0", "token_uri": "https://oauth2.googleapis.com/token",
+        }, f)
+
+
+def _prepare_workdir(scratch):
+    workdir = os.path.join(scratch, "functions")
+    shutil.rmtree(workdir, ignore_errors=True)
+    shutil.copytree(FUNCTIONS_DIR, workdir, ignore=shutil.ignore_patterns("__pycache__", "venv"))
+    prompt = os.path.join(workdir, "CLAUDE.md")
+    if not os.path.exists(prompt):
+        with open(prompt, "w") as f:
+            f.write("# NexMath benchmark placeholder prompt\n")
+    return workdir
+
+
+def _package_breakdown(stderr):
+    """Sum ``-X importtime`` self-time (ms) per top-level package."""
+    totals = {}
+    for line in stderr.splitlines():
+        match = _IMPORTTIME_RE.match(line)
+        if not match:
+            continue
+        package = match.group(4).split(".")[0]
+        totals[package] = totals.get(package, 0) + int(match.group(1)) / 1000
+    return totals
+
+
+def _run_once(target, workdir, env):
+    env = {**env, "FUNCTION_TARGET": target}
+    spawned = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", os.path.abspath(__file__), "--child", target],
+        cwd=workdir, env=env, capture_output=True, text=True, timeout=120,
+    )
+    wall_ms = (time.perf_counter() - spawned) * 1000
+    lines = [line for line in proc.stdout.splitlines() if line.startswith("{")]
+    if proc.returncode != 0 or not lines:
+        tail = "\n".join(l for l in proc.stderr.splitlines() if not l.startswith("import time:"))[-2000:]
+        raise RuntimeError(f"{target} run failed (exit {proc.returncode}):\n{tail}")
+    result = json.loads(lines[-1])
+    result["wall_ms"] = wall_ms
+    result["packages"] = _package_breakdown(proc.stderr)
+    return result
+
+
+def _summarize(runs):
+    summary = {
+        metric: round(statistics.median(r[metric] for r in runs), 1)
+        for metric in ("import_ms", "first_response_ms", "wall_ms")
+    }
+    packages = {}
+    for run in runs:
+        for name, ms in run["packages"].items():
+            packages.setdefault(name, []).append(ms)
+    summary["packages"] = {name: round(statistics.median(v + [0] * (len(runs) - len(v))), 1)
+                           for name, v in packages.items()}
+    summary["loaded"] = runs[-1]["loaded"]
+    summary["status"] = runs[-1]["status"]
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--child", choices=TARGETS, help=argparse.SUPPRESS)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="packages to list per target")
+    parser.add_argument("--targets", default=",".join(TARGETS))
+    parser.add_argument("--json", help="write the medians to this file")
+    parser.add_argument("--baseline", help="compare against a file written by --json")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    if args.child:
+        _child(args.child)
+        return 0
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _FakeMessagesAPI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    scratch = tempfile.mkdtemp(prefix="nexmath-startup-")
+    credentials = os.path.join(scratch, "service-account.json")
+    _write_service_account(credentials)
+    workdir = _prepare_workdir(scratch)
+
+    env = {
+        **os.environ,
+        "ANTHROPIC_API_KEY": "bench",
+        "ANTHROPIC_BASE_URL": f"http://127.0.0.1:{server.server_address[1]}",
+        "GOOGLE_APPLICATION_CREDENTIALS": credentials,
+        "GOOGLE_CLOUD_PROJECT": "nexmath-bench",
+    }
+
+    results = {}
+    try:
+        for target in args.targets.split(","):
+            # One untimed run so the bytecode cache is warm, as in a deployed image
+            _run_once(target, workdir, env)
+            runs = [_run_once(target, workdir, env) for _ in range(args.runs)]
+            results[target] = _summarize(runs)
+    finally:
+        server.shutdown()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    for target, summary in results.items():
+        print(f"\n{target} (median of {args.runs}, status {summary['status']})")
+        print(f"  import main.py      {summary['import_ms']:8.1f} ms")
+        print(f"  first response      {summary['first_response_ms']:8.1f} ms")
+        print(f"  spawn to response   {summary['wall_ms']:8.1f} ms")
+        print(f"  heavy modules       {', '.join(summary['loaded']) or 'none'}")
+        print("  import self-time by package:")
+        ranked = sorted(summary["packages"].items(), key=lambda item: -item[1])
+        for name, ms in ranked[:args.top]:
+            print(f"    {name:<28}{ms:8.1f} ms")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = []
+        for target, summary in results.items():
+            for metric in ("import_ms", "first_response_ms"):
+                before = baseline.get(target, {}).get(metric)
+                if before and summary[metric] > before * (1 + args.tolerance):
+                    regressions.append(f"{target} {metric}: {before} -> {summary[metric]} ms")
+        if regressions:
+            print("\nRegressions beyond {:.0%}:".format(args.tolerance))
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print(f"\nNo regressions beyond {args.tolerance:.0%} of {args.baseline}.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,193 @@
+"""
+Append-only conversation storage in Firestore.
+
+Each conversation is a small header document plus one document per message:
+
+    conversations/{session_id}                   message_count, total_tokens,
+                                                 opening_end, last_accessed
+    conversations/{session_id}/messages/{seq}    seq, role, content, _tokens
+
+A turn writes only its new message documents and updates the header in one
+transaction, so write cost no longer grows with the conversation and no
+document approaches Firestore's 1 MiB limit. The transaction reads
+message_count itself: two turns of one session saved at once (two tabs, a
+retried request) get consecutive sequence numbers instead of overwriting each
+other's messages. Loading reads the header first and then only the messages
+trim_conversation can keep: everything when the history fits the token
+budget, otherwise the opening exchange plus the most recent messages that
+fill the budget.
+
+Conversations saved by the old layout (the whole history in a "messages"
+array on the conversation document) are read as before and moved into the
+subcollection on their next write.
+"""
+from firebase_admin import firestore
+
+# Tail pages after the first, which is sized from the budget
+_PAGE_SIZE = 50
+# Firestore allows 500 writes per batch
+_BATCH_LIMIT = 500
+
+
+def _doc_id(seq):
+    # Zero-padded so document IDs sort in message order in the console
+    return f"{seq:08d}"
+
+
+def _to_doc(seq, message, tokens):
+    return {"seq": seq, "role": message["role"], "content": message["content"], "_tokens": tokens}
+
+
+def _from_doc(snapshot):
+    data = snapshot.to_dict()
+    message = {"role": data["role"], "content": data["content"]}
+    if "_tokens" in data:
+        message["_tokens"] = data["_tokens"]
+    return message
+
+
+class FirestoreConversation:
+    """One session's history: ``load(budget)`` a window, then ``append(new_messages)``."""
+
+    def __init__(self, db, session_id, token_count):
+        self._db = db
+        self.ref = db.collection("conversations").document(session_id)
+        self._messages = self.ref.collection("messages")
+        self._token_count = token_count
+        self.message_count = 0
+        self.total_tokens = 0
+        self.opening_end = None
+        self._legacy = None
+
+    def _read_ordered(self, limit=None):
+        query = self._messages.order_by("seq")
+        if limit is not None:
+            query = query.limit(limit)
+        return [_from_doc(doc) for doc in query.stream()]
+
+    def _first_page_size(self, budget):
+        """Messages the budget holds at this conversation's average size, plus one to cross it."""
+        average = max(1, self.total_tokens) / self.message_count
+        return max(1, min(self.message_count, int(budget / average) + 2))
+
+    def _read_tail(self, budget):
+        """Newest messages, oldest first, until they hold more than ``budget`` tokens."""
+        tail, tokens, last_seq = [], 0, None
+        page_size = self._first_page_size(budget)
+        while tokens <= budget:
+            query = self._messages.order_by("seq", direction=firestore.Query.DESCENDING)
+            if last_seq is not None:
+                query = query.start_after({"seq": last_seq})
+            docs = list(query.limit(page_size).stream())
+            for doc in docs:
+                message = _from_doc(doc)
+                tail.append(message)
+                tokens += self._token_count(message)
+                last_seq = doc.get("seq")
+                if tokens > budget:
+                    break
+            if len(docs) < page_size:
+                break
+            page_size = _PAGE_SIZE
+        tail.reverse()
+        return tail, last_seq
+
+    def load(self, budget):
+        """
+        Return the stored history trim_conversation needs for a ``budget`` of
+        history tokens. Older messages that could not be kept are not read.
+        """
+        snapshot = self.ref.get()
+        if not snapshot.exists:
+            return []
+        header = snapshot.to_dict()
+
+        if "messages" in header:
+            self._legacy = header["messages"]
+            self.message_count = len(self._legacy)
+            return list(self._legacy)
+
+        self.message_count = header.get("message_count", 0)
+        self.total_tokens = header.get("total_tokens", 0)
+        self.opening_end = header.get("opening_end")
+        if not self.message_count:
+            return []
+        if self.total_tokens <= budget:
+            return self._read_ordered()
+
+        tail, first_seq = self._read_tail(budget)
+        if first_seq is None:
+            return []
+        # An exchange cut off at the front of the window could not have been
+        # kept whole, so the window starts at its next user message.
+        while tail and tail[0]["role"] != "user":
+            tail.pop(0)
+            first_seq += 1
+        if first_seq == 0:
+            return tail
+        opening_end = min(self.opening_end or self.message_count, first_seq)
+        return self._read_ordered(limit=opening_end) + tail
+
+    def append(self, new_messages, last_accessed):
+        """Write ``new_messages`` after the stored ones and update the header, in one transaction."""
+        if self._legacy is not None:
+            self._migrate_legacy()
+        entries = [(message, self._token_count(message)) for message in new_messages]
+
+        @firestore.transactional
+        def write(transaction):
+            # Read the count inside the transaction; a concurrent turn makes it retry
+            snapshot = self.ref.get(transaction=transaction)
+            header = snapshot.to_dict() or {}
+            seq = header.get("message_count", 0)
+            total_tokens = header.get("total_tokens", 0)
+            opening_end = header.get("opening_end")
+            for message, message_tokens in entries:
+                if opening_end is None and seq > 0 and message["role"] == "user":
+                    opening_end = seq
+                transaction.set(self._messages.document(_doc_id(seq)), _to_doc(seq, message, message_tokens))
+                total_tokens += message_tokens
+                seq += 1
+            update = {"message_count": seq, "total_tokens": total_tokens, "last_accessed": last_accessed}
+            if opening_end is not None:
+                update["opening_end"] = opening_end
+            transaction.set(self.ref, update, merge=True)
+            return seq, total_tokens, opening_end
+
+        self.message_count, self.total_tokens, self.opening_end = write(self._db.transaction())
+
+    def _migrate_legacy(self):
+        """
+        Move the old inline history into the subcollection. The documents are
+        the same whoever writes them, so two turns migrating at once agree;
+        only the first one to update the header removes the inline array.
+        """
+        legacy = self._legacy
+        batch, pending = self._db.batch(), 0
+        tokens = 0
+        opening_end = None
+        for seq, message in enumerate(legacy):
+            if pending == _BATCH_LIMIT:
+                batch.commit()
+                batch, pending = self._db.batch(), 0
+            message_tokens = self._token_count(message)
+            if opening_end is None and seq > 0 and message["role"] == "user":
+                opening_end = seq
+            batch.set(self._messages.document(_doc_id(seq)), _to_doc(seq, message, message_tokens))
+            tokens += message_tokens
+            pending += 1
+        if pending:
+            batch.commit()
+
+        @firestore.transactional
+        def finish(transaction):
+            snapshot = self.ref.get(transaction=transaction)
+            if "messages" not in (snapshot.to_dict() or {}):
+                return
+            header = {"message_count": len(legacy), "total_tokens": tokens, "messages": firestore.DELETE_FIELD}
+            if opening_end is not None:
+                header["opening_end"] = opening_end
+            transaction.set(self.ref, header, merge=True)
+
+        finish(self._db.transaction())
+        self._legacy = None
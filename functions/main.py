@@ -1,104 +1,278 @@
 from firebase_functions import https_fn, options
-from firebase_admin import initialize_app, firestore
-from anthropic import Anthropic
-from system_prompt import get_system_prompt, get_mode_instruction, get_explain_followup_instruction
+from system_prompt import approx_token_count, get_system_prompt, get_compiled_prompt, get_mode_instruction, get_explain_followup_instruction
+from plot_worker import PlotWorkerPool
+from image_pipeline import ImageRejected, image_stats, normalize_image
+from plot_cache import PlotCache, plot_cache_key
+from timing import RequestTimer
+import response_scan
 import os
 import uuid
 import re
 import subprocess
 import sys
-import tempfile
 import base64
 import json
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 
-initialize_app()
+# firebase_admin, Firestore, anthropic/httpx and Pillow are imported on first
+# use, so health (and deploy-time function discovery) never load them. The
+# Functions runtime sets FUNCTION_TARGET to the function an instance serves;
+# chat and chat_stream instances preload the heavy stack at start-up instead
+# (see _preload).
+FUNCTION_TARGET = os.environ.get("FUNCTION_TARGET", "")
 
 # Model configuration
 MODEL = os.environ.get("CLAUDE_MODEL", "claude-sonnet-4-20250514")
 MAX_TOKENS = 4096
-MAX_MESSAGES = 40
+# Context budget (estimated tokens) for system prompt + history + new turn + reply
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "150000"))
+# Vision tokens per image (the API downsizes images to about 1.15 megapixels, ~1600 tokens)
+IMAGE_TOKEN_ESTIMATE = 1600
+
+# Anthropic API connection pool, kept by warm instances between invocations
+ANTHROPIC_MAX_CONNECTIONS = int(os.environ.get("ANTHROPIC_MAX_CONNECTIONS", "20"))
+ANTHROPIC_KEEPALIVE_SECS = float(os.environ.get("ANTHROPIC_KEEPALIVE_SECS", "120"))
+
+# chat_stream: function timeout (s), and how much of it to keep for rendering
+# plots and writing Firestore after the text (plot time is added when plots are on)
+STREAM_TIMEOUT_SEC = 300
+STREAM_FINISH_RESERVE = 10
+
+# Mark the system prompt and conversation prefix as cacheable upstream
+PROMPT_CACHING = os.environ.get("PROMPT_CACHING", "1") == "1"
+
+# Report per-stage latency in Server-Timing headers and a final "timing" SSE event
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "1") == "1"
+
+# Uploaded image normalization: long-edge limit (px), upload limit (MB), output encoding
+IMAGE_MAX_EDGE = int(os.environ.get("IMAGE_MAX_EDGE", "1568"))
+IMAGE_MAX_MB = float(os.environ.get("IMAGE_MAX_MB", "10"))
+IMAGE_FORMAT = os.environ.get("IMAGE_FORMAT", "JPEG").upper()
+IMAGE_QUALITY = int(os.environ.get("IMAGE_QUALITY", "85"))
+
+# Plot rendering: warm worker pool size, jobs per worker before recycling, per-job timeout (s)
+PLOT_POOL_SIZE = int(os.environ.get("PLOT_POOL_SIZE", "2"))
+PLOT_WORKER_MAX_JOBS = int(os.environ.get("PLOT_WORKER_MAX_JOBS", "50"))
+PLOT_TIMEOUT = float(os.environ.get("PLOT_TIMEOUT", "15"))
+PLOT_DPI = 100
+# Wall-clock budget for all plot blocks of one response; late blocks fall back to code
+PLOT_RESPONSE_DEADLINE = float(os.environ.get("PLOT_RESPONSE_DEADLINE", "20"))
+
+# Rendered plot cache: memory LRU budget (MB), optional disk directory and its budget (MB)
+PLOT_CACHE_MB = float(os.environ.get("PLOT_CACHE_MB", "64"))
+PLOT_CACHE_DIR = os.environ.get("PLOT_CACHE_DIR", "")
+PLOT_CACHE_DISK_MB = float(os.environ.get("PLOT_CACHE_DISK_MB", "256"))
+
 _PLOT_PYTHON = None
+_PLOT_POOL = None
+_PLOT_EXECUTOR = None
+_PLOT_POOL_LOCK = threading.Lock()
+_ANTHROPIC_CLIENT = None
+_ANTHROPIC_CLIENT_LOCK = threading.Lock()
+_FIRESTORE_DB = None
+_FIRESTORE_LOCK = threading.Lock()
+
+plot_cache = PlotCache(
+    max_bytes=int(PLOT_CACHE_MB * 1024 * 1024),
+    disk_dir=PLOT_CACHE_DIR or None,
+    disk_max_bytes=int(PLOT_CACHE_DISK_MB * 1024 * 1024),
+)
+
+
+def _message_tokens(message):
+    """Estimated tokens of a stored message, computed once and cached on it as "_tokens"."""
+    tokens = message.get("_tokens")
+    if tokens is None:
+        content = message["content"]
+        if isinstance(content, str):
+            tokens = approx_token_count(content)
+        else:
+            tokens = sum(
+                IMAGE_TOKEN_ESTIMATE if block.get("type") == "image"
+                else approx_token_count(block.get("text", ""))
+                for block in content
+            )
+        message["_tokens"] = tokens
+    return tokens
+
+
+def _history_message(role, content):
+    """A history entry with its token estimate precomputed, so every store persists it."""
+    message = {"role": role, "content": content}
+    _message_tokens(message)
+    return message
 
 
 def trim_conversation(messages):
-    """Keep conversation within context limits."""
-    if len(messages) <= MAX_MESSAGES:
+    """
+    Keep system prompt + history + the new turn within CONTEXT_TOKEN_BUDGET.
+
+    History is dropped a whole exchange (a user message and its replies) at a
+    time: oldest first after the opening exchange, which goes last. The new
+    turn is always kept and the result always starts with a user message.
+    """
+    budget = CONTEXT_TOKEN_BUDGET - get_compiled_prompt().approx_tokens - MAX_TOKENS
+    total = sum(_message_tokens(m) for m in messages)
+    if total <= budget and (not messages or messages[0]["role"] == "user"):
+        return messages
+
+    starts = [i for i, m in enumerate(messages) if m["role"] == "user"]
+    if not starts:
         return messages
-    return messages[:2] + messages[-(MAX_MESSAGES - 2):]
+    bounds = list(zip(starts, starts[1:] + [len(messages)]))
+    total -= sum(_message_tokens(m) for m in messages[:starts[0]])
+
+    # Drop order: second exchange onward, then the opening one; never the new turn
+    history = bounds[:-1]
+    if not history:
+        # Only the new turn is left (an oversized paste); send it on its own
+        return messages[bounds[-1][0]:]
+    kept = set(range(len(history)))
+    for index in list(range(1, len(history))) + [0]:
+        if total <= budget:
+            break
+        start, end = history[index]
+        total -= sum(_message_tokens(m) for m in messages[start:end])
+        kept.discard(index)
+
+    trimmed = [m for index in sorted(kept) for m in messages[slice(*history[index])]]
+    return trimmed + messages[bounds[-1][0]:]
 
 
 def execute_python_code(code):
     """Execute Python matplotlib code and return base64-encoded PNG."""
     try:
-        def _sanitize_code(raw):
-            lines = raw.splitlines()
-            cleaned = []
-            code_like = re.compile(
-                r'^\s*(#|import |from |plt\.|np\.|matplotlib|sns\.|ax\.|fig\.|'
-                r'for |if |elif |else:|while |def |class |with |try:|except |return|'
-                r'pass|break|continue|[A-Za-z_][A-Za-z0-9_]*(\s*,\s*[A-Za-z_][A-Za-z0-9_]*)*\s*=|'
-                r'[A-Za-z_][A-Za-z0-9_]*\s*\(|[\]\)\}])'
-            )
-            for line in lines:
-                if "```" in line:
-                    continue
-                if line.strip() == "":
-                    cleaned.append(line)
-                    continue
-                if code_like.search(line):
-                    cleaned.append(line)
-                else:
-                    cleaned.append("# " + line)
-            return "\n".join(cleaned)
-
-        sanitized_code = re.sub(r'^\s*plt\.show\(\)\s*$', '', code, flags=re.MULTILINE)
-        sanitized_code = _sanitize_code(sanitized_code)
-
-        wrapper = f"""
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import numpy as np
-
-# User code
-{sanitized_code}
-
-# Save the figure
-plt.savefig('plot.png', dpi=100, bbox_inches='tight')
-plt.close()
-"""
-        with tempfile.TemporaryDirectory() as tmpdir:
-            script_path = os.path.join(tmpdir, 'script.py')
-            plot_path = os.path.join(tmpdir, 'plot.png')
-
-            with open(script_path, 'w') as f:
-                f.write(wrapper)
-
-            result = subprocess.run(
-                [_get_plot_python(), script_path],
-                cwd=tmpdir,
-                capture_output=True,
-                timeout=15,
-                text=True
-            )
-
-            if os.path.exists(plot_path):
-                with open(plot_path, 'rb') as f:
-                    img_data = base64.b64encode(f.read()).decode('utf-8')
-                return img_data
-
-            if result.stderr:
-                print(f"Plot stderr: {result.stderr}")
-            if result.returncode != 0:
-                print(f"Plot process exited with code {result.returncode}")
-            return None
+        sanitized_code = response_scan.sanitize_plot_code(code)
+
+        cache_key = plot_cache_key(sanitized_code, dpi=PLOT_DPI, backend="Agg")
+        png = plot_cache.get(cache_key)
+        if png is None:
+            png = _get_plot_pool().render(sanitized_code, dpi=PLOT_DPI)
+            plot_cache.put(cache_key, png)
+        if png:
+            return base64.b64encode(png).decode('utf-8')
+        return None
 
     except Exception as e:
         print(f"Code execution error: {e}")
         return None
 
 
+class _ConnectionStats:
+    """
+    Counts upstream requests that opened a new connection versus reused a
+    pooled one, and how long new connections took to set up (TCP + TLS).
+    Fed by httpcore's per-request trace events.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+        self.connect_seconds = 0.0
+        self.connect_max = 0.0
+
+    def tracer(self):
+        """A trace callback for one request."""
+        state = {"connect_started": None, "connected": None}
+
+        def trace(event, info):
+            if event == "connection.connect_tcp.started":
+                state["connect_started"] = time.perf_counter()
+            elif event in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+                if state["connect_started"] is not None:
+                    state["connected"] = time.perf_counter() - state["connect_started"]
+            elif event.endswith("send_request_headers.started"):
+                self._record(state["connected"])
+                state["connect_started"] = state["connected"] = None
+
+        return trace
+
+    def _record(self, connect_seconds):
+        with self._lock:
+            self.requests += 1
+            if connect_seconds is not None:
+                self.new_connections += 1
+                self.connect_seconds += connect_seconds
+                self.connect_max = max(self.connect_max, connect_seconds)
+        if connect_seconds is not None:
+            print(f"Anthropic API: new connection, set up in {connect_seconds * 1000:.1f} ms")
+
+    def stats(self):
+        with self._lock:
+            reused = self.requests - self.new_connections
+            return {
+                "requests": self.requests,
+                "new_connections": self.new_connections,
+                "reused_connections": reused,
+                "reuse_ratio": round(reused / self.requests, 4) if self.requests else 0.0,
+                "connect_ms_avg": round(self.connect_seconds * 1000 / self.new_connections, 2) if self.new_connections else 0.0,
+                "connect_ms_max": round(self.connect_max * 1000, 2),
+            }
+
+
+upstream_connections = _ConnectionStats()
+
+
+def _get_anthropic_client():
+    """Create the Anthropic client on first use; warm instances reuse it and its open connections."""
+    global _ANTHROPIC_CLIENT
+    if _ANTHROPIC_CLIENT is None:
+        with _ANTHROPIC_CLIENT_LOCK:
+            if _ANTHROPIC_CLIENT is None:
+                from anthropic import Anthropic, DefaultHttpxClient
+                import httpx
+
+                def _attach_tracer(request):
+                    request.extensions["trace"] = upstream_connections.tracer()
+
+                http_client = DefaultHttpxClient(
+                    limits=httpx.Limits(
+                        max_connections=ANTHROPIC_MAX_CONNECTIONS,
+                        max_keepalive_connections=ANTHROPIC_MAX_CONNECTIONS,
+                        keepalive_expiry=ANTHROPIC_KEEPALIVE_SECS,
+                    ),
+                    event_hooks={"request": [_attach_tracer]},
+                )
+                _ANTHROPIC_CLIENT = Anthropic(
+                    api_key=os.environ.get("ANTHROPIC_API_KEY"),
+                    http_client=http_client,
+                )
+    return _ANTHROPIC_CLIENT
+
+
+def _get_db():
+    """Initialize Firebase and the Firestore client on first use."""
+    global _FIRESTORE_DB
+    if _FIRESTORE_DB is None:
+        with _FIRESTORE_LOCK:
+            if _FIRESTORE_DB is None:
+                import firebase_admin
+                from firebase_admin import firestore
+
+                if not firebase_admin._apps:
+                    firebase_admin.initialize_app()
+                _FIRESTORE_DB = firestore.client()
+    return _FIRESTORE_DB
+
+
+def _get_plot_pool():
+    """Create the plot worker pool on first use; warm instances keep it."""
+    global _PLOT_POOL
+    if _PLOT_POOL is None:
+        with _PLOT_POOL_LOCK:
+            if _PLOT_POOL is None:
+                _PLOT_POOL = PlotWorkerPool(
+                    _get_plot_python(),
+                    size=PLOT_POOL_SIZE,
+                    max_jobs=PLOT_WORKER_MAX_JOBS,
+                    timeout=PLOT_TIMEOUT,
+                )
+    return _PLOT_POOL
+
+
 def _get_plot_python():
     """Pick a Python interpreter with matplotlib installed."""
     global _PLOT_PYTHON
@@ -121,60 +295,105 @@ def _get_plot_python():
     return _PLOT_PYTHON
 
 
+def _render_plot_blocks(codes):
+    """Render plot blocks in parallel; blocks past the response deadline come back as None."""
+    futures = [_get_plot_executor().submit(execute_python_code, code) for code in codes]
+    done, not_done = wait(futures, timeout=PLOT_RESPONSE_DEADLINE)
+    if not_done:
+        print(f"{len(not_done)} plot block(s) missed the {PLOT_RESPONSE_DEADLINE}s response deadline.")
+    return [f.result() if f in done else None for f in futures]
+
+
+def _get_plot_executor():
+    global _PLOT_EXECUTOR
+    if _PLOT_EXECUTOR is None:
+        with _PLOT_POOL_LOCK:
+            if _PLOT_EXECUTOR is None:
+                _PLOT_EXECUTOR = ThreadPoolExecutor(
+                    max_workers=max(1, PLOT_POOL_SIZE), thread_name_prefix="plot-render"
+                )
+    return _PLOT_EXECUTOR
+
+
 def process_response_with_plots(text, allow_plots=True):
     """Find Python code blocks in the response, execute them, and replace with images."""
     if not allow_plots:
         return text
 
-    pattern = r'```[^\n]*\r?\n(.*?)```'
-
-    def replace_code_block(match):
-        code = match.group(1)
-        if 'matplotlib' in code or 'plt.' in code:
-            img_base64 = execute_python_code(code)
-            if img_base64:
-                return f'''<div class="plot-container">
+    found = response_scan.scan(text)
+    if found.plots:
+        images = _render_plot_blocks([fence.code for fence in found.plots])
+        return response_scan.splice(text, found.plots, [
+            f'''<div class="plot-container">
 <img src="data:image/png;base64,{img_base64}" alt="Plot" class="matplotlib-plot">
-</div>'''
-        return match.group(0)
+</div>''' if img_base64 else None
+            for img_base64 in images
+        ])
+
+    if found.bare:
+        img_base64 = execute_python_code(found.bare.code)
+        if img_base64:
+            image_html = (
+                f'<div class="plot-container">'
+                f'<img src="data:image/png;base64,{img_base64}" alt="Plot" class="matplotlib-plot">'
+                f'</div>'
+            )
+            return "\n".join([found.bare.before, image_html, found.bare.after]).strip()
+    return text
+
+
+def _system_blocks():
+    """System prompt as a content block marked for prompt caching."""
+    block = {"type": "text", "text": get_system_prompt()}
+    if PROMPT_CACHING:
+        block["cache_control"] = {"type": "ephemeral"}
+    return [block]
+
+
+def _request_messages(messages):
+    """
+    Copy of the history to send upstream, without bookkeeping keys ("_tokens")
+    and with a cache breakpoint on the last block so the whole conversation
+    prefix is reused on the next turn. The stored history is left untouched.
+    """
+    messages = [{"role": m["role"], "content": m["content"]} for m in messages]
+    if not PROMPT_CACHING or not messages:
+        return messages
+    last = messages[-1]
+    content = last["content"]
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    else:
+        content = list(content)
+    content[-1] = {**content[-1], "cache_control": {"type": "ephemeral"}}
+    return messages[:-1] + [{**last, "content": content}]
 
-    processed = re.sub(pattern, replace_code_block, text, flags=re.DOTALL)
 
-    if processed == text and ("matplotlib" in text or "plt." in text):
-        lines = text.splitlines()
-        start_idx = None
-        code_line_re = re.compile(
-            r'^\s*(#|import |from |plt\.|np\.|[A-Za-z_][A-Za-z0-9_]*\s*=|[A-Za-z_][A-Za-z0-9_]*\s*\()'
-        )
+def _usage_dict(usage):
+    """Token usage of one upstream call, including prompt-cache reads and writes."""
+    if usage is None:
+        return {}
+    return {
+        "input_tokens": getattr(usage, "input_tokens", 0) or 0,
+        "output_tokens": getattr(usage, "output_tokens", 0) or 0,
+        "cache_read_input_tokens": getattr(usage, "cache_read_input_tokens", 0) or 0,
+        "cache_creation_input_tokens": getattr(usage, "cache_creation_input_tokens", 0) or 0,
+    }
 
-        for i, line in enumerate(lines):
-            if re.search(r'^\s*(import matplotlib|from matplotlib|import numpy|import matplotlib\.pyplot)', line) or "plt." in line:
-                start_idx = i
-                break
-
-        if start_idx is not None:
-            end_idx = None
-            for i in range(start_idx, len(lines)):
-                if code_line_re.search(lines[i]) or lines[i].strip() == "":
-                    end_idx = i
-                else:
-                    if end_idx is not None and i > end_idx + 1:
-                        break
-
-            if end_idx is not None:
-                code = "\n".join(lines[start_idx:end_idx + 1])
-                img_base64 = execute_python_code(code)
-                if img_base64:
-                    image_html = (
-                        f'<div class="plot-container">'
-                        f'<img src="data:image/png;base64,{img_base64}" alt="Plot" class="matplotlib-plot">'
-                        f'</div>'
-                    )
-                    before = "\n".join(lines[:start_idx])
-                    after = "\n".join(lines[end_idx + 1:])
-                    return "\n".join([before, image_html, after]).strip()
-
-    return processed
+
+def _normalize_upload(image_data, image_type):
+    """Decode, EXIF-rotate, downscale and re-encode an uploaded image."""
+    image_data, image_type, stats = normalize_image(
+        image_data,
+        image_type,
+        max_edge=IMAGE_MAX_EDGE,
+        max_input_bytes=int(IMAGE_MAX_MB * 1024 * 1024),
+        output_format=IMAGE_FORMAT,
+        quality=IMAGE_QUALITY,
+    )
+    print(f"Image normalized: {stats['bytes_in']} -> {stats['bytes_out']} bytes, "
+          f"{stats['size_in'][0]}x{stats['size_in'][1]} -> {stats['size_out'][0]}x{stats['size_out'][1]}")
+    return image_data, image_type
 
 
 def _user_asked_for_plot(text):
@@ -225,24 +444,25 @@ def _make_cors_headers():
     }
 
 
-@https_fn.on_request(
-    memory=options.MemoryOption.GB_1,
-    timeout_sec=120,
-    secrets=["ANTHROPIC_API_KEY"],
-)
-def chat(req: https_fn.Request) -> https_fn.Response:
-    """Main chat endpoint — replaces /api/chat from Flask."""
+def _json_response(payload, status=200, timer=None):
+    headers = {**_make_cors_headers(), "Content-Type": "application/json"}
+    if SERVER_TIMING and timer is not None:
+        headers["Server-Timing"] = timer.header()
+        # Lets the cross-origin client read it from the Performance API
+        headers["Timing-Allow-Origin"] = "*"
+    return https_fn.Response(json.dumps(payload), status=status, headers=headers)
 
-    # Handle CORS preflight
-    if req.method == "OPTIONS":
-        return https_fn.Response("", status=204, headers=_make_cors_headers())
 
+def _prepare_turn(req, timer):
+    """
+    Validate a chat request and load its conversation.
+
+    Returns (turn, None) where turn holds the session ID, the stored
+    conversation, the new user message and the trimmed messages to send
+    upstream, or (None, response) when the request is rejected.
+    """
     if req.method != "POST":
-        return https_fn.Response(
-            json.dumps({"error": "Method not allowed"}),
-            status=405,
-            headers={**_make_cors_headers(), "Content-Type": "application/json"},
-        )
+        return None, _json_response({"error": "Method not allowed"}, 405)
 
     data = req.get_json(silent=True) or {}
 
@@ -259,11 +479,14 @@ def chat(req: https_fn.Request) -> https_fn.Response:
     exam_answer = data.get("exam_answer", False)
 
     if not user_text and not image_data:
-        return https_fn.Response(
-            json.dumps({"error": "Please provide a message or image."}),
-            status=400,
-            headers={**_make_cors_headers(), "Content-Type": "application/json"},
-        )
+        return None, _json_response({"error": "Please provide a message or image."}, 400)
+
+    if image_data:
+        try:
+            with timer.span("image"):
+                image_data, image_type = _normalize_upload(image_data, image_type)
+        except ImageRejected as e:
+            return None, _json_response({"error": str(e)}, 400, timer)
 
     if not user_text and image_data:
         user_text = "Please analyze this calculus problem and help me understand how to approach it."
@@ -275,18 +498,14 @@ def chat(req: https_fn.Request) -> https_fn.Response:
     )
 
     # Firestore for conversation persistence
-    db = firestore.client()
+    history_started = time.perf_counter()
+    from conversation_store import FirestoreConversation
+    db = _get_db()
 
     if not session_id:
         session_id = str(uuid.uuid4())
 
-    conv_ref = db.collection("conversations").document(session_id)
-    conv_doc = conv_ref.get()
-
-    if conv_doc.exists:
-        messages = conv_doc.to_dict().get("messages", [])
-    else:
-        messages = []
+    conversation = FirestoreConversation(db, session_id, _message_tokens)
 
     # Build content blocks for Claude API
     content = []
@@ -301,50 +520,211 @@ def chat(req: https_fn.Request) -> https_fn.Response:
         })
     content.append({"type": "text", "text": prefixed_text})
 
-    messages.append({"role": "user", "content": content})
-    messages = trim_conversation(messages)
-
+    user_message = _history_message("user", content)
     try:
-        client = Anthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
+        # Read only the stored window trimming could keep alongside the new turn
+        history_budget = (CONTEXT_TOKEN_BUDGET - get_compiled_prompt().approx_tokens
+                          - MAX_TOKENS - _message_tokens(user_message))
+        messages = conversation.load(history_budget)
+        messages.append(user_message)
+        messages = trim_conversation(messages)
+    except Exception as e:
+        return None, _json_response({"error": str(e)}, 500, timer)
+    timer.mark("history", since=history_started)
 
-        response = client.messages.create(
-            model=MODEL,
-            max_tokens=MAX_TOKENS,
-            system=get_system_prompt(),
-            messages=messages,
-        )
+    return {
+        "session_id": session_id,
+        "conversation": conversation,
+        "user_message": user_message,
+        "messages": messages,
+        "allow_plots": plot_mode == "auto" or _user_asked_for_plot(user_text),
+    }, None
 
-        assistant_text = response.content[0].text
 
-        # Process matplotlib plots
-        allow_plots = plot_mode == "auto" or _user_asked_for_plot(user_text)
-        processed_text = process_response_with_plots(assistant_text, allow_plots=allow_plots)
+@https_fn.on_request(
+    memory=options.MemoryOption.GB_1,
+    timeout_sec=120,
+    secrets=["ANTHROPIC_API_KEY"],
+)
+def chat(req: https_fn.Request) -> https_fn.Response:
+    """Main chat endpoint — replaces /api/chat from Flask."""
 
-        # Store assistant response (original text for conversation history)
-        messages.append({"role": "assistant", "content": assistant_text})
+    # Handle CORS preflight
+    if req.method == "OPTIONS":
+        return https_fn.Response("", status=204, headers=_make_cors_headers())
 
-        # Save to Firestore
-        conv_ref.set({
-            "messages": messages,
-            "last_accessed": time.time(),
-        })
+    timer = RequestTimer()
+    turn, error_response = _prepare_turn(req, timer)
+    if error_response is not None:
+        return error_response
 
-        return https_fn.Response(
-            json.dumps({"response": processed_text, "session_id": session_id}),
-            status=200,
-            headers={**_make_cors_headers(), "Content-Type": "application/json"},
-        )
+    try:
+        with timer.span("prompt"):
+            system = _system_blocks()
+            upstream_messages = _request_messages(turn["messages"])
+
+        with timer.span("upstream"):
+            response = _get_anthropic_client().messages.create(
+                model=MODEL,
+                max_tokens=MAX_TOKENS,
+                system=system,
+                messages=upstream_messages,
+            )
+
+        assistant_text = response.content[0].text
+
+        # Process matplotlib plots
+        with timer.span("plots"):
+            processed_text = process_response_with_plots(assistant_text, allow_plots=turn["allow_plots"])
+
+        # Store the turn (original text for conversation history); only the
+        # two new messages are written
+        with timer.span("persist"):
+            turn["conversation"].append(
+                [turn["user_message"], _history_message("assistant", assistant_text)],
+                last_accessed=time.time(),
+            )
+
+        return _json_response({
+            "response": processed_text,
+            "session_id": turn["session_id"],
+            "usage": _usage_dict(response.usage),
+        }, timer=timer)
 
     except Exception as e:
-        # Remove failed user message
-        if messages and messages[-1].get("role") == "user":
-            messages.pop()
+        # Nothing was written, so the failed user message is not persisted
         print(f"Chat error: {e}")
-        return https_fn.Response(
-            json.dumps({"error": str(e)}),
-            status=500,
-            headers={**_make_cors_headers(), "Content-Type": "application/json"},
-        )
+        return _json_response({"error": str(e)}, 500, timer)
+
+
+@https_fn.on_request(
+    memory=options.MemoryOption.GB_1,
+    timeout_sec=STREAM_TIMEOUT_SEC,
+    secrets=["ANTHROPIC_API_KEY"],
+)
+def chat_stream(req: https_fn.Request) -> https_fn.Response:
+    """
+    Streaming chat endpoint — the /api/chat-stream SSE protocol from Flask.
+
+    Emits "delta" events as text arrives, then one "done" event with the
+    processed response (plots rendered), or an "error" event. The turn is
+    written to Firestore once, after the model finishes. If the answer is
+    still streaming when the function is about to time out, it is cut off
+    there. The partial text is stored, and "done" reports truncated: true.
+    """
+    started = time.monotonic()
+    timer = RequestTimer()
+
+    if req.method == "OPTIONS":
+        return https_fn.Response("", status=204, headers=_make_cors_headers())
+
+    turn, error_response = _prepare_turn(req, timer)
+    if error_response is not None:
+        return error_response
+
+    # Leave time after the text for plot rendering and the Firestore write
+    reserve = STREAM_FINISH_RESERVE + (PLOT_RESPONSE_DEADLINE if turn["allow_plots"] else 0)
+    text_deadline = started + STREAM_TIMEOUT_SEC - reserve
+
+    def event(payload):
+        return f"data: {json.dumps(payload)}\n\n"
+
+    def generate():
+        assistant_text_parts = []
+        truncated = False
+        usage = {}
+        try:
+            with timer.span("prompt"):
+                system = _system_blocks()
+                upstream_messages = _request_messages(turn["messages"])
+
+            upstream_started = time.perf_counter()
+            first_token_at = None
+            with _get_anthropic_client().messages.stream(
+                model=MODEL,
+                max_tokens=MAX_TOKENS,
+                system=system,
+                messages=upstream_messages,
+                timeout=max(1.0, text_deadline - time.monotonic()),
+            ) as stream:
+                # The httpx timeout only bounds each read, so a slow trickle of
+                # tokens could run past the function timeout. Closing the
+                # response at the deadline ends the read loop wherever it waits.
+                cut_off = threading.Event()
+
+                def close_at_deadline():
+                    cut_off.set()
+                    stream.response.close()
+
+                deadline_timer = threading.Timer(max(0.0, text_deadline - time.monotonic()), close_at_deadline)
+                deadline_timer.daemon = True
+                deadline_timer.start()
+                try:
+                    for text in stream.text_stream:
+                        if text:
+                            if first_token_at is None:
+                                first_token_at = time.perf_counter()
+                                timer.mark("ttft", since=upstream_started)
+                            assistant_text_parts.append(text)
+                            yield event({"type": "delta", "text": text})
+                        if time.monotonic() >= text_deadline:
+                            truncated = True
+                            break
+                except Exception:
+                    if not cut_off.is_set():
+                        raise
+                    truncated = True
+                finally:
+                    deadline_timer.cancel()
+                if not truncated:
+                    usage = _usage_dict(stream.get_final_message().usage)
+            timer.mark("generate", since=first_token_at or upstream_started)
+
+            assistant_text = "".join(assistant_text_parts)
+            if truncated:
+                print(f"Stream cut off after {time.monotonic() - started:.1f}s to finish within "
+                      f"the {STREAM_TIMEOUT_SEC}s function timeout.")
+            with timer.span("plots"):
+                processed_text = process_response_with_plots(assistant_text, allow_plots=turn["allow_plots"])
+
+            with timer.span("persist"):
+                turn["conversation"].append(
+                    [turn["user_message"], _history_message("assistant", assistant_text)],
+                    last_accessed=time.time(),
+                )
+
+            yield event({
+                "type": "done",
+                "response": processed_text,
+                "session_id": turn["session_id"],
+                "usage": usage,
+                "truncated": truncated,
+            })
+        except Exception as e:
+            # Nothing was written, so the failed user message is not persisted
+            print(f"Chat stream error: {e}")
+            yield event({"type": "error", "error": str(e)})
+
+        if SERVER_TIMING:
+            yield event({"type": "timing", "timing": timer.as_dict()})
+
+    headers = {}
+    if SERVER_TIMING:
+        # Stages before the stream starts; the full breakdown is the final "timing" event
+        headers["Server-Timing"] = timer.header(include_total=False)
+        headers["Timing-Allow-Origin"] = "*"
+    return https_fn.Response(
+        generate(),
+        status=200,
+        headers={
+            **headers,
+            **_make_cors_headers(),
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+            # Ask proxies not to buffer the stream
+            "X-Accel-Buffering": "no",
+        },
+    )
 
 
 @https_fn.on_request(
@@ -357,7 +737,32 @@ def health(req: https_fn.Request) -> https_fn.Response:
         return https_fn.Response("", status=204, headers=_make_cors_headers())
 
     return https_fn.Response(
-        json.dumps({"status": "ok", "model": MODEL}),
+        json.dumps({
+            "status": "ok",
+            "model": MODEL,
+            "plot_cache": plot_cache.stats(),
+            "images": image_stats(),
+            "upstream": upstream_connections.stats(),
+        }),
         status=200,
         headers={**_make_cors_headers(), "Content-Type": "application/json"},
     )
+
+
+def _preload():
+    """Build the system prompt, Anthropic client and Firestore client before the first chat."""
+    try:
+        get_compiled_prompt()
+    except OSError as e:
+        print(f"System prompt not compiled at start-up: {e}")
+    try:
+        _get_anthropic_client()
+        _get_db()
+        import image_pipeline
+        image_pipeline.load_pillow()
+    except Exception as e:
+        print(f"Chat dependencies not preloaded: {e}")
+
+
+if FUNCTION_TARGET in ("chat", "chat_stream"):
+    _preload()
@@ -0,0 +1,49 @@
+"""
+Per-request stage timing.
+
+A RequestTimer collects named spans (auth, history, upstream, plots, ...) as
+wall-clock durations and renders them as a ``Server-Timing`` header or a
+plain dict for the final ``timing`` SSE event. Spans with the same name add
+up. Recording a span is two perf_counter() calls and a dict update, cheap
+enough to leave on in production.
+"""
+import time
+from contextlib import contextmanager
+
+
+class RequestTimer:
+    """Stage durations for one request, in the order the stages first ran."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._spans = {}
+
+    @contextmanager
+    def span(self, name):
+        """Time the enclosed block as stage ``name``."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        self._spans[name] = self._spans.get(name, 0.0) + seconds
+
+    def mark(self, name, since=None):
+        """Record the time from ``since`` (default: request start) until now as ``name``."""
+        self.add(name, time.perf_counter() - (self.started if since is None else since))
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def as_dict(self, include_total=True):
+        """Stage durations in milliseconds."""
+        timings = {name: round(seconds * 1000, 1) for name, seconds in self._spans.items()}
+        if include_total:
+            timings["total"] = round(self.elapsed() * 1000, 1)
+        return timings
+
+    def header(self, include_total=True):
+        """Value for a Server-Timing header, e.g. ``auth;dur=1.2, upstream;dur=840.0``."""
+        return ", ".join(f"{name};dur={ms}" for name, ms in self.as_dict(include_total).items())
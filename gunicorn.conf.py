@@ -0,0 +1,35 @@
+"""
+Gunicorn settings for the Flask app. Every value can be overridden from the
+environment.
+
+The default gevent worker serves requests cooperatively: while a chat stream
+waits on the Anthropic API (or a plot waits on a render worker process) the
+worker keeps serving other students, so one process holds hundreds of open
+SSE streams. CPU-bound request work (normalizing an uploaded image) would
+block that loop, so app.py runs it on gevent's native thread pool. Set
+GUNICORN_WORKER_CLASS=gthread for a thread-per-request worker, or sync for
+the old one-request-per-worker behaviour.
+
+SESSION_BACKEND=sqlite defaults to gthread instead. sqlite3 calls are not
+cooperative, so under gevent every session read or write (including a
+30-second busy wait on a locked database) stalls all streams in the
+process, and the store's per-thread connections become per-greenlet, so
+each request opens a new one.
+"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", "1"))
+_sqlite_sessions = os.environ.get("SESSION_BACKEND", "memory") == "sqlite"
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread" if _sqlite_sessions else "gevent")
+if _sqlite_sessions and worker_class == "gevent":
+    print("Warning: SESSION_BACKEND=sqlite blocks the gevent event loop; use GUNICORN_WORKER_CLASS=gthread.")
+
+# gevent: concurrent requests (open streams) per worker process
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", "500"))
+# gthread: threads per worker process
+threads = int(os.environ.get("GUNICORN_THREADS", "32"))
+
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "180"))
+graceful_timeout = 30
+keepalive = 5
@@ -0,0 +1,126 @@
+"""
+Ingestion stage for uploaded images.
+
+Decodes the base64 upload, applies the EXIF orientation, downscales it so the
+long edge is at most ``max_edge`` pixels and re-encodes it, before the image
+is stored or sent to the model. Oversized or undecodable uploads are rejected
+with ImageRejected before any of that work happens.
+"""
+import base64
+import binascii
+import io
+import threading
+
+# Formats the Messages API accepts as input
+_ACCEPTED_FORMATS = {"JPEG", "PNG", "GIF", "WEBP"}
+_MEDIA_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "GIF": "image/gif", "WEBP": "image/webp"}
+
+# Pillow is imported on first use; importing this module stays cheap
+_PIL = None
+
+_stats_lock = threading.Lock()
+_stats = {"images": 0, "rejected": 0, "bytes_in": 0, "bytes_out": 0}
+
+
+class ImageRejected(ValueError):
+    """The upload is too large, not an image, or in an unsupported format."""
+
+
+def image_stats():
+    """Totals since start-up: images processed, rejected, and bytes before/after."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def load_pillow():
+    """Import Pillow once and return its (Image, ImageOps) modules."""
+    global _PIL
+    if _PIL is None:
+        from PIL import Image, ImageOps
+        _PIL = (Image, ImageOps)
+    return _PIL
+
+
+def _record(**deltas):
+    with _stats_lock:
+        for key, value in deltas.items():
+            _stats[key] += value
+
+
+def normalize_image(data, media_type=None, max_edge=1568, max_input_bytes=10 * 1024 * 1024,
+                    max_pixels=40_000_000, output_format="JPEG", quality=85):
+    """
+    Normalize a base64 image upload.
+
+    Returns (base64 data, media type, stats) where stats holds the byte counts
+    and pixel sizes before and after. The original is returned untouched when
+    it is already small enough, upright and re-encoding would not shrink it.
+    """
+    # base64 inflates by 4/3, so the encoded length bounds the decoded size
+    if not data or len(data) * 3 // 4 > max_input_bytes:
+        _record(rejected=1)
+        raise ImageRejected(f"Image is too large (limit {max_input_bytes // (1024 * 1024)} MB).")
+    try:
+        raw = base64.b64decode(data, validate=True)
+    except (binascii.Error, ValueError):
+        _record(rejected=1)
+        raise ImageRejected("Image data is not valid base64.")
+
+    Image, ImageOps = load_pillow()
+    try:
+        img = Image.open(io.BytesIO(raw))
+        source_format = img.format
+        if source_format not in _ACCEPTED_FORMATS:
+            raise ImageRejected(f"Unsupported image format: {source_format or 'unknown'}.")
+        width, height = img.size
+        if width * height > max_pixels:
+            raise ImageRejected("Image dimensions are too large.")
+
+        # Let the JPEG decoder skip detail we are about to throw away
+        if source_format == "JPEG":
+            img.draft("RGB", (max_edge, max_edge))
+        img.load()
+    except ImageRejected:
+        _record(rejected=1)
+        raise
+    except Exception:
+        _record(rejected=1)
+        raise ImageRejected("Could not decode the image.")
+
+    orientation = img.getexif().get(0x0112, 1)
+    needs_resize = max(width, height) > max_edge
+    if not needs_resize and orientation == 1 and source_format == output_format:
+        _record(images=1, bytes_in=len(raw), bytes_out=len(raw))
+        return data, _MEDIA_TYPES[source_format], {
+            "bytes_in": len(raw), "bytes_out": len(raw), "size_in": (width, height), "size_out": (width, height),
+        }
+
+    img = ImageOps.exif_transpose(img)
+    if max(img.size) > max_edge:
+        img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+    if output_format == "JPEG" and img.mode not in ("RGB", "L"):
+        # JPEG has no alpha: flatten onto white so transparent screenshots stay legible
+        rgba = img.convert("RGBA")
+        flattened = Image.new("RGB", rgba.size, (255, 255, 255))
+        flattened.paste(rgba, mask=rgba.getchannel("A"))
+        img = flattened
+
+    buf = io.BytesIO()
+    save_kwargs = {"optimize": True}
+    if output_format in ("JPEG", "WEBP"):
+        save_kwargs["quality"] = quality
+    img.save(buf, format=output_format, **save_kwargs)
+    encoded = buf.getvalue()
+
+    if not needs_resize and orientation == 1 and len(encoded) >= len(raw):
+        # Re-encoding did not help; keep the original bytes
+        encoded, output_format = raw, source_format
+        out = data
+    else:
+        out = base64.b64encode(encoded).decode("ascii")
+
+    _record(images=1, bytes_in=len(raw), bytes_out=len(encoded))
+    return out, _MEDIA_TYPES[output_format], {
+        "bytes_in": len(raw), "bytes_out": len(encoded), "size_in": (width, height), "size_out": img.size,
+    }
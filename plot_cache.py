@@ -0,0 +1,157 @@
+"""
+Content-addressed cache for rendered plots.
+
+Keys are a SHA-256 of the sanitized plot code plus the render settings, so
+identical code rendered the same way is only executed once. Entries live in a
+bounded in-memory LRU, optionally backed by an on-disk directory that is
+trimmed oldest-first once it grows past its byte budget.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+def plot_cache_key(code, dpi=100, backend="Agg"):
+    """Hash sanitized code together with everything that changes the PNG."""
+    digest = hashlib.sha256()
+    digest.update(f"{backend}\0{dpi}\0".encode("utf-8"))
+    digest.update(code.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def plot_digest(png):
+    """Content address of a rendered PNG, used as its public plot ID."""
+    return hashlib.sha256(png).hexdigest()
+
+
+class PlotCache:
+    """Two-tier (memory LRU + optional disk) cache of PNG bytes."""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, disk_dir=None, disk_max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._disk_bytes = sum(size for _, _, size in self._disk_files())
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.png")
+
+    def _disk_files(self):
+        """Yield (mtime, path, size) for every cached file on disk."""
+        try:
+            names = os.listdir(self.disk_dir)
+        except OSError:
+            return
+        for name in names:
+            if not name.endswith(".png"):
+                continue
+            path = os.path.join(self.disk_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            yield st.st_mtime, path, st.st_size
+
+    def _remember(self, key, png):
+        """Insert into the memory tier and evict least-recently-used entries."""
+        if len(png) > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old)
+        self._entries[key] = png
+        self._bytes += len(png)
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+
+    def get(self, key):
+        """Return cached PNG bytes for ``key`` or None."""
+        with self._lock:
+            png = self._entries.get(key)
+            if png is not None:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return png
+
+            if self.disk_dir:
+                path = self._disk_path(key)
+                try:
+                    with open(path, "rb") as f:
+                        png = f.read()
+                    os.utime(path)  # Mark as recently used for disk eviction
+                except OSError:
+                    png = None
+                if png:
+                    self.disk_hits += 1
+                    self._remember(key, png)
+                    return png
+
+            self.misses += 1
+            return None
+
+    def put(self, key, png):
+        """Store PNG bytes under ``key`` in both tiers."""
+        if not png:
+            return
+        with self._lock:
+            self._remember(key, png)
+            if self.disk_dir:
+                self._write_disk(key, png)
+
+    def _write_disk(self, key, png):
+        path = self._disk_path(key)
+        if os.path.exists(path):
+            return
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(png)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Plot cache disk write failed: {e}")
+            return
+        self._disk_bytes += len(png)
+        if self._disk_bytes > self.disk_max_bytes:
+            self._evict_disk()
+
+    def _evict_disk(self):
+        """Delete the oldest files until the disk tier is back under budget."""
+        files = sorted(self._disk_files())
+        total = sum(size for _, _, size in files)
+        target = int(self.disk_max_bytes * 0.9)
+        for _, path, size in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                continue
+        self._disk_bytes = total
+
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            hits = self.memory_hits + self.disk_hits
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "disk_bytes": self._disk_bytes,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": round(hits / lookups, 4) if lookups else 0.0,
+            }
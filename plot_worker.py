@@ -0,0 +1,333 @@
+"""
+Warm matplotlib rendering workers.
+
+Each worker is a separate Python process that imports matplotlib and numpy
+once and then serves jobs sent over its stdin. It never runs job code itself:
+for every job it forks a child, which inherits the warm imports, renders the
+code and sends the PNG back through a private pipe. A job therefore sees fresh
+module state (``np``, ``plt``, ``builtins``) and an empty working directory of
+its own, no matter what earlier jobs from other students did, and a job that
+runs past its timeout is killed by the worker without losing the worker. Workers are still recycled after a fixed
+number of jobs or after a crash.
+
+Run directly (``python plot_worker.py``) this file is the worker itself.
+"""
+import io
+import json
+import os
+import queue
+import select
+import shutil
+import signal
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+_FRAME_HEADER = struct.Struct(">I")
+_WORKER_SCRIPT = os.path.abspath(__file__)
+# Extra time the pool allows a worker beyond the job timeout before killing it
+_WORKER_GRACE = 5
+
+
+class PlotWorkerError(Exception):
+    """Raised when a worker dies or stops responding mid-job."""
+
+
+def _write_frame(stream, payload):
+    stream.write(_FRAME_HEADER.pack(len(payload)))
+    stream.write(payload)
+    stream.flush()
+
+
+def _read_exact(fd, size, deadline):
+    """Read exactly ``size`` bytes from ``fd`` before ``deadline`` (monotonic)."""
+    chunks = []
+    remaining = size
+    while remaining:
+        wait = deadline - time.monotonic()
+        if wait <= 0:
+            raise TimeoutError("plot worker timed out")
+        ready, _, _ = select.select([fd], [], [], wait)
+        if not ready:
+            raise TimeoutError("plot worker timed out")
+        chunk = os.read(fd, remaining)
+        if not chunk:
+            raise PlotWorkerError("plot worker exited unexpectedly")
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+def _read_frame(fd, deadline):
+    (size,) = _FRAME_HEADER.unpack(_read_exact(fd, _FRAME_HEADER.size, deadline))
+    return _read_exact(fd, size, deadline)
+
+
+class _Worker:
+    """One pre-imported rendering process and its private scratch directory."""
+
+    def __init__(self, python):
+        self.workdir = tempfile.mkdtemp(prefix="nexmath-plot-")
+        self.jobs = 0
+        self.proc = subprocess.Popen(
+            [python, _WORKER_SCRIPT],
+            cwd=self.workdir,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def render(self, code, dpi, timeout):
+        """
+        Send one job and wait for its result. Returns (png_bytes, stdout, stderr)
+        and raises TimeoutError if the worker killed the job at ``timeout``.
+        Raises PlotWorkerError if the worker itself stops responding; its reply
+        may still arrive later, so such a worker must not serve another job.
+        """
+        self.jobs += 1
+        request = json.dumps({"code": code, "dpi": dpi, "timeout": timeout}).encode("utf-8")
+        try:
+            _write_frame(self.proc.stdin, request)
+        except (BrokenPipeError, OSError) as e:
+            raise PlotWorkerError(f"plot worker unavailable: {e}")
+
+        # The worker enforces the job timeout; this only catches a wedged worker
+        deadline = time.monotonic() + timeout + _WORKER_GRACE
+        fd = self.proc.stdout.fileno()
+        try:
+            header = json.loads(_read_frame(fd, deadline).decode("utf-8"))
+            png = _read_frame(fd, deadline) or None
+        except TimeoutError:
+            raise PlotWorkerError("plot worker stopped responding")
+        if header.get("timed_out"):
+            raise TimeoutError("plot job timed out")
+        return png, header.get("stdout", ""), header.get("stderr", "")
+
+    def close(self):
+        if self.alive():
+            self.proc.kill()
+        try:
+            self.proc.wait(timeout=5)
+        except Exception:
+            pass
+        for stream in (self.proc.stdin, self.proc.stdout):
+            try:
+                stream.close()
+            except Exception:
+                pass
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+class PlotWorkerPool:
+    """
+    Bounded pool of warm rendering workers.
+
+    ``size`` caps how many plots render at once, ``max_jobs`` recycles a worker
+    after that many jobs (each job already runs in its own forked child), and
+    ``timeout`` is the per-job wall-clock limit after which the job is killed.
+    """
+
+    def __init__(self, python, size=2, max_jobs=50, timeout=15):
+        self.python = python
+        self.size = max(1, size)
+        self.max_jobs = max(1, max_jobs)
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._lock = threading.Lock()
+        self._workers = set()
+        self._closed = False
+        self._counts = {"rendered": 0, "failed": 0, "timed_out": 0, "saturated": 0, "recycled": 0}
+
+    def _count(self, outcome):
+        with self._lock:
+            self._counts[outcome] += 1
+
+    def _spawn(self):
+        worker = _Worker(self.python)
+        with self._lock:
+            self._workers.add(worker)
+        return worker
+
+    def _retire(self, worker):
+        with self._lock:
+            self._workers.discard(worker)
+            self._counts["recycled"] += 1
+        worker.close()
+
+    def start(self):
+        """Pre-fork every worker so the first plots skip interpreter start-up."""
+        while self._idle.qsize() < self.size:
+            self._idle.put(self._spawn())
+
+    def render(self, code, dpi=100, timeout=None):
+        """Render sanitized plot code and return PNG bytes, or None on failure."""
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        if not self._slots.acquire(timeout=timeout):
+            print("Plot pool saturated; no worker became free in time.")
+            self._count("saturated")
+            return None
+        try:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                worker = None
+            if worker is None or not worker.alive():
+                if worker is not None:
+                    self._retire(worker)
+                worker = self._spawn()
+
+            try:
+                png, out, err = worker.render(code, dpi, max(0.1, deadline - time.monotonic()))
+            except TimeoutError:
+                print(f"Plot execution timed out after {timeout}s.")
+                self._count("timed_out")
+                if worker.alive() and not self._closed:
+                    # The worker killed the job and sent its whole reply, so it is ready for the next one
+                    self._idle.put(worker)
+                else:
+                    self._retire(worker)
+                return None
+            except Exception as e:
+                print(f"Plot worker error: {e}; recycling worker.")
+                self._count("failed")
+                self._retire(worker)
+                return None
+
+            if err:
+                print(f"Plot stderr: {err}")
+            if out:
+                print(f"Plot stdout: {out}")
+            if png is None and not err:
+                print("Plot execution completed but no plot was generated.")
+            self._count("rendered" if png else "failed")
+
+            if self._closed or worker.jobs >= self.max_jobs:
+                self._retire(worker)
+            else:
+                self._idle.put(worker)
+            return png
+        finally:
+            self._slots.release()
+
+    def stats(self):
+        """Job outcomes since start-up plus the current number of live and idle workers."""
+        with self._lock:
+            return {**self._counts, "workers": len(self._workers), "idle": self._idle.qsize(), "size": self.size}
+
+    def shutdown(self):
+        self._closed = True
+        with self._lock:
+            workers = list(self._workers)
+            self._workers.clear()
+        for worker in workers:
+            worker.close()
+
+
+def _render_job(job, result_fd):
+    """Forked child: run one job with the inherited imports, write header and PNG frames."""
+    import contextlib
+    import traceback
+
+    import matplotlib
+    import matplotlib.pyplot as plt
+    import numpy as np
+
+    out, err = io.StringIO(), io.StringIO()
+    png = b""
+    namespace = {"__name__": "__main__", "matplotlib": matplotlib, "plt": plt, "np": np}
+    try:
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            exec(compile(job["code"], "<plot>", "exec"), namespace)
+            buf = io.BytesIO()
+            plt.savefig(buf, format="png", dpi=job.get("dpi", 100), bbox_inches="tight")
+            png = buf.getvalue()
+    except BaseException:
+        err.write(traceback.format_exc())
+
+    with os.fdopen(result_fd, "wb") as result:
+        reply = {"stdout": out.getvalue(), "stderr": err.getvalue()}
+        _write_frame(result, json.dumps(reply).encode("utf-8"))
+        _write_frame(result, png)
+
+
+def _run_job(job, proto_out_fd):
+    """
+    Fork a child for ``job`` in a new scratch directory and collect its reply,
+    killing it at the job timeout. The directory is removed afterwards.
+    """
+    jobdir = tempfile.mkdtemp(prefix="job-", dir=os.getcwd())
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            # The job must not see the worker's protocol streams or other jobs' files
+            os.close(read_fd)
+            os.close(proto_out_fd)
+            devnull = os.open(os.devnull, os.O_RDONLY)
+            os.dup2(devnull, 0)
+            os.close(devnull)
+            os.chdir(jobdir)
+            _render_job(job, write_fd)
+        except BaseException:
+            status = 1
+        finally:
+            # Skip atexit handlers and buffered protocol streams inherited from the worker
+            os._exit(status)
+
+    os.close(write_fd)
+    deadline = time.monotonic() + job.get("timeout", 15)
+    try:
+        reply = _read_frame(read_fd, deadline)
+        png = _read_frame(read_fd, deadline)
+    except TimeoutError:
+        os.kill(pid, signal.SIGKILL)
+        reply, png = json.dumps({"stderr": "plot job timed out", "timed_out": True}).encode("utf-8"), b""
+    except PlotWorkerError as e:
+        reply, png = json.dumps({"stderr": str(e)}).encode("utf-8"), b""
+    finally:
+        os.close(read_fd)
+        os.waitpid(pid, 0)
+        shutil.rmtree(jobdir, ignore_errors=True)
+    return reply, png
+
+
+def _worker_main():
+    """Worker loop: read a job frame, render it in a forked child, write a header and PNG frame."""
+    # Keep the real stdout for the protocol and send anything else to stderr.
+    proto_out = os.fdopen(os.dup(1), "wb")
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+    proto_in = sys.stdin.buffer
+
+    import matplotlib
+    matplotlib.use("Agg")  # Non-interactive backend
+    import matplotlib.pyplot as plt
+    import numpy as np  # noqa: F401  (imported here so every child inherits it)
+
+    # Load fonts and the Agg renderer once, so children start fully warm
+    plt.figure()
+    plt.plot([0, 1])
+    plt.savefig(io.BytesIO(), format="png")
+    plt.close("all")
+
+    while True:
+        header = proto_in.read(_FRAME_HEADER.size)
+        if len(header) < _FRAME_HEADER.size:
+            return
+        (size,) = _FRAME_HEADER.unpack(header)
+        job = json.loads(proto_in.read(size).decode("utf-8"))
+        reply, png = _run_job(job, proto_out.fileno())
+        _write_frame(proto_out, reply)
+        _write_frame(proto_out, png)
+
+
+if __name__ == "__main__":
+    _worker_main()
@@ -0,0 +1,102 @@
+"""
+Exact-match cache for first-turn answers.
+
+Many conversations open with the same request ("explain the chain rule",
+"Quiz me on limits"), differing only in case or spacing. The key is a SHA-256
+of the normalized message, the mode, the answer options, the model and the
+system-prompt hash. Editing the prompt or switching models therefore never
+serves an old answer. Entries live in an in-memory LRU bounded by count and
+bytes and expire ``ttl`` seconds after they were stored. Each worker process
+keeps its own cache.
+"""
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+def normalize_request_text(text):
+    """Case-fold and collapse whitespace, so trivially different requests share a key."""
+    return " ".join(text.split()).casefold()
+
+
+def response_cache_key(text, mode, options, prompt_sha256, model):
+    payload = json.dumps({
+        "text": normalize_request_text(text),
+        "mode": mode,
+        "options": options,
+        "prompt": prompt_sha256,
+        "model": model,
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def replay_chunks(text, size=256):
+    """Split a cached answer into delta-sized pieces for a streamed replay."""
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+class ResponseCache:
+    """LRU of answer text with a TTL, bounded by entry count and total bytes."""
+
+    def __init__(self, ttl=24 * 3600, max_entries=2000, max_bytes=32 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (expires_at, text, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return the cached answer for ``key`` or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                self._drop(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, text):
+        """Store ``text`` under ``key``, evicting least recently used entries past the bounds."""
+        if not text:
+            return
+        size = len(text.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = (time.monotonic() + self.ttl, text, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self.evictions += 1
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "expirations": self.expirations,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
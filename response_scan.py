@@ -0,0 +1,137 @@
+"""
+Single-pass scanner for model responses.
+
+Finds fenced code blocks and matplotlib plot candidates in one sweep over the
+text, using str.find for the fences rather than a DOTALL regex. When no fenced
+block holds plot code, it looks for a bare (unfenced) plot snippet, line by
+line. All patterns are compiled once at import. A response that never
+mentions matplotlib or ``plt.`` is passed over after two substring checks.
+
+A fence is the same as the old ``r'```[^\\n]*\\r?\\n(.*?)```'`` DOTALL pattern.
+It opens at three backticks, its info string runs to the end of the line, and
+it closes at the next three backticks, even mid-line. PlotBlockStream relies
+on this to keep its renders lined up with the final text.
+"""
+import re
+from typing import NamedTuple
+
+FENCE = "```"
+
+# Lines kept as code when sanitizing a plot block; anything else is commented out
+_CODE_LIKE_RE = re.compile(
+    r'\s*(#|import |from |plt\.|np\.|matplotlib|sns\.|ax\.|fig\.|'
+    r'for |if |elif |else:|while |def |class |with |try:|except |return|'
+    r'pass|break|continue|[A-Za-z_][A-Za-z0-9_]*(\s*,\s*[A-Za-z_][A-Za-z0-9_]*)*\s*=|'
+    r'[A-Za-z_][A-Za-z0-9_]*\s*\(|[\]\)\}])'
+)
+# Blocking show() calls would hang the worker until its timeout
+_SHOW_RE = re.compile(r'^\s*plt\.show\(\)\s*$', re.MULTILINE)
+# First line of an unfenced plot snippet, and the lines that continue it
+_BARE_START_RE = re.compile(r'\s*(import matplotlib|from matplotlib|import numpy)')
+_BARE_LINE_RE = re.compile(r'\s*(#|import |from |plt\.|np\.|[A-Za-z_][A-Za-z0-9_]*\s*=|[A-Za-z_][A-Za-z0-9_]*\s*\()')
+
+
+class Fence(NamedTuple):
+    start: int
+    end: int
+    code: str
+
+
+class BareSnippet(NamedTuple):
+    """Unfenced plot code, with the text around it rejoined line by line."""
+    before: str
+    code: str
+    after: str
+
+
+class ResponseScan(NamedTuple):
+    plots: list
+    bare: BareSnippet = None
+
+
+def is_plot_code(code):
+    return "matplotlib" in code or "plt." in code
+
+
+def iter_fences(text, pos=0):
+    """Yield every complete fenced block in ``text`` from ``pos`` on."""
+    find = text.find
+    while True:
+        opening = find(FENCE, pos)
+        if opening < 0:
+            return
+        body = find("\n", opening + 3) + 1
+        if not body:
+            return
+        closing = find(FENCE, body)
+        if closing < 0:
+            return
+        pos = closing + 3
+        yield Fence(opening, pos, text[body:closing])
+
+
+def scan(text):
+    """Plot blocks in ``text`` in order, or the bare snippet when there are none."""
+    if not is_plot_code(text):
+        # Plot code always carries a marker, so no fence can qualify
+        return ResponseScan([])
+    plots = [fence for fence in iter_fences(text) if is_plot_code(fence.code)]
+    if plots:
+        return ResponseScan(plots)
+    return ResponseScan([], _find_bare_snippet(text))
+
+
+def _find_bare_snippet(text):
+    lines = text.splitlines()
+    start_idx = None
+    for i, line in enumerate(lines):
+        if "plt." in line or _BARE_START_RE.match(line):
+            start_idx = i
+            break
+    if start_idx is None:
+        return None
+
+    end_idx = None
+    for i in range(start_idx, len(lines)):
+        line = lines[i]
+        if _BARE_LINE_RE.match(line) or line.strip() == "":
+            end_idx = i
+        elif end_idx is not None and i > end_idx + 1:
+            # Stop at a clear prose line after the code started
+            break
+    if end_idx is None:
+        return None
+    return BareSnippet(
+        "\n".join(lines[:start_idx]),
+        "\n".join(lines[start_idx:end_idx + 1]),
+        "\n".join(lines[end_idx + 1:]),
+    )
+
+
+def splice(text, fences, replacements):
+    """Replace each fence with its replacement; a falsy replacement keeps the block."""
+    parts = []
+    pos = 0
+    for fence, replacement in zip(fences, replacements):
+        if not replacement:
+            continue
+        parts.append(text[pos:fence.start])
+        parts.append(replacement)
+        pos = fence.end
+    if not parts:
+        return text
+    parts.append(text[pos:])
+    return "".join(parts)
+
+
+def sanitize_plot_code(code):
+    """Drop plt.show() calls and stray fences, and comment out prose lines."""
+    cleaned = []
+    for line in _SHOW_RE.sub("", code).splitlines():
+        if FENCE in line:
+            continue
+        if not line.strip() or _CODE_LIKE_RE.match(line):
+            cleaned.append(line)
+        else:
+            cleaned.append("# " + line)
+    return "\n".join(cleaned)
@@ -0,0 +1,435 @@
+"""
+Conversation history storage for the Flask app.
+
+Two interchangeable backends share one interface (create / exists / get /
+append / pop / replace / delete / put_image / get_image / sweep / stats):
+
+- MemorySessionStore keeps sessions in process memory. It only works with a
+  single gunicorn worker.
+- SQLiteSessionStore keeps them in a WAL-mode SQLite file that every worker
+  process on the host can open, with one row appended per message.
+
+Both are held to a budget: at most ``max_sessions`` sessions and
+``max_bytes`` of message payload. The least recently used session is evicted
+when either limit is exceeded, and a background sweeper drops sessions idle
+longer than ``idle_ttl`` seconds. Uploaded images are stored once by content
+hash, outside the message history, under their own ``max_image_bytes`` budget.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+def message_bytes(value):
+    """Approximate in-memory payload of a message (string lengths, recursively)."""
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(len(k) + message_bytes(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(message_bytes(v) for v in value)
+    return 8
+
+
+class _Session:
+    __slots__ = ("messages", "bytes", "last_access")
+
+    def __init__(self):
+        self.messages = []
+        self.bytes = 0
+        self.last_access = time.monotonic()
+
+
+class _SweeperMixin:
+    """Background thread that calls ``self.sweep()`` every ``sweep_interval`` seconds."""
+
+    def start_sweeper(self):
+        if self._sweeper is not None:
+            return
+
+        def _run():
+            while not self._stop.wait(self.sweep_interval):
+                try:
+                    self.sweep()
+                except Exception as e:
+                    print(f"Session sweep failed: {e}")
+
+        self._sweeper = threading.Thread(target=_run, name="session-sweeper", daemon=True)
+        self._sweeper.start()
+
+    def close(self):
+        self._stop.set()
+
+
+class MemorySessionStore(_SweeperMixin):
+    """Bounded, LRU-evicting, idle-expiring session store. Thread-safe."""
+
+    def __init__(self, max_sessions=1000, max_bytes=256 * 1024 * 1024, idle_ttl=6 * 3600, sweep_interval=60,
+                 max_image_bytes=64 * 1024 * 1024):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.sweep_interval = sweep_interval
+        self.max_image_bytes = max_image_bytes
+        self._sessions = OrderedDict()
+        self._bytes = 0
+        self._images = OrderedDict()
+        self._image_bytes = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sweeper = None
+        self.evictions = 0
+        self.expirations = 0
+
+    def _touch(self, session_id):
+        session = self._sessions.get(session_id)
+        if session is not None:
+            session.last_access = time.monotonic()
+            self._sessions.move_to_end(session_id)
+        return session
+
+    def _drop(self, session_id):
+        session = self._sessions.pop(session_id, None)
+        if session is not None:
+            self._bytes -= session.bytes
+        return session
+
+    def _enforce_budget(self, keep=None):
+        """Evict least recently used sessions (never ``keep``) until within budget."""
+        while len(self._sessions) > self.max_sessions or self._bytes > self.max_bytes:
+            victim = next(iter(self._sessions))
+            if victim == keep:
+                if len(self._sessions) == 1:
+                    return
+                self._sessions.move_to_end(keep)
+                continue
+            self._drop(victim)
+            self.evictions += 1
+
+    def create(self, session_id=None):
+        """Start an empty session and return its ID."""
+        session_id = session_id or str(uuid.uuid4())
+        with self._lock:
+            self._drop(session_id)
+            self._sessions[session_id] = _Session()
+            self._enforce_budget(keep=session_id)
+        return session_id
+
+    def exists(self, session_id):
+        with self._lock:
+            return session_id in self._sessions
+
+    def get(self, session_id):
+        """Return a copy of the session's message list ([] if unknown)."""
+        with self._lock:
+            session = self._touch(session_id)
+            return list(session.messages) if session else []
+
+    def append(self, session_id, message):
+        """Append a message, recreating the session if it was evicted meanwhile."""
+        size = message_bytes(message)
+        with self._lock:
+            session = self._touch(session_id)
+            if session is None:
+                session = self._sessions[session_id] = _Session()
+            session.messages.append(message)
+            session.bytes += size
+            self._bytes += size
+            self._enforce_budget(keep=session_id)
+
+    def pop(self, session_id):
+        """Remove and return the last message of a session, if any."""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if not session or not session.messages:
+                return None
+            message = session.messages.pop()
+            size = message_bytes(message)
+            session.bytes -= size
+            self._bytes -= size
+            return message
+
+    def replace(self, session_id, messages):
+        """Overwrite a session's history (used after trimming)."""
+        size = sum(message_bytes(m) for m in messages)
+        with self._lock:
+            self._drop(session_id)
+            session = self._sessions[session_id] = _Session()
+            session.messages = list(messages)
+            session.bytes = size
+            self._bytes += size
+            self._enforce_budget(keep=session_id)
+
+    def delete(self, session_id):
+        with self._lock:
+            self._drop(session_id)
+
+    def put_image(self, digest, media_type, data):
+        """Store an uploaded image (base64) under its content hash."""
+        with self._lock:
+            if digest in self._images:
+                self._images.move_to_end(digest)
+                return
+            self._images[digest] = (media_type, data)
+            self._image_bytes += len(data)
+            while self._image_bytes > self.max_image_bytes and len(self._images) > 1:
+                _, (_, evicted) = self._images.popitem(last=False)
+                self._image_bytes -= len(evicted)
+
+    def get_image(self, digest):
+        """Return (media_type, base64 data) for a stored image, or None."""
+        with self._lock:
+            image = self._images.get(digest)
+            if image is not None:
+                self._images.move_to_end(digest)
+            return image
+
+    def sweep(self):
+        """Drop sessions idle for longer than ``idle_ttl``. Returns how many were dropped."""
+        cutoff = time.monotonic() - self.idle_ttl
+        dropped = 0
+        with self._lock:
+            # Sessions are ordered by last access, so stop at the first fresh one
+            while self._sessions:
+                session_id, session = next(iter(self._sessions.items()))
+                if session.last_access > cutoff:
+                    break
+                self._drop(session_id)
+                dropped += 1
+            self.expirations += dropped
+        return dropped
+
+    def stats(self):
+        """Current footprint of the store."""
+        with self._lock:
+            return {
+                "backend": "memory",
+                "sessions": len(self._sessions),
+                "messages": sum(len(s.messages) for s in self._sessions.values()),
+                "bytes": self._bytes,
+                "images": len(self._images),
+                "image_bytes": self._image_bytes,
+                "max_sessions": self.max_sessions,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class SQLiteSessionStore(_SweeperMixin):
+    """
+    Session store in a WAL-mode SQLite database shared by all worker processes.
+
+    Each message is one row keyed by (session_id, seq), so a turn only inserts
+    its new messages. Budget and TTL are enforced by sweep(), which every
+    worker runs periodically.
+    """
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            id TEXT PRIMARY KEY,
+            last_access REAL NOT NULL,
+            bytes INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS sessions_last_access ON sessions (last_access);
+        CREATE TABLE IF NOT EXISTS messages (
+            session_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            message TEXT NOT NULL,
+            bytes INTEGER NOT NULL,
+            PRIMARY KEY (session_id, seq)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS images (
+            digest TEXT PRIMARY KEY,
+            media_type TEXT NOT NULL,
+            data TEXT NOT NULL,
+            bytes INTEGER NOT NULL,
+            last_access REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path, max_sessions=10000, max_bytes=1024 * 1024 * 1024, idle_ttl=6 * 3600, sweep_interval=60,
+                 max_image_bytes=256 * 1024 * 1024):
+        self.path = path
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.sweep_interval = sweep_interval
+        self.max_image_bytes = max_image_bytes
+        self._local = threading.local()
+        self._stop = threading.Event()
+        self._sweeper = None
+        self.evictions = 0
+        self.expirations = 0
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(self._SCHEMA)
+
+    def _conn(self):
+        """
+        One connection per thread; sqlite3 connections are not shareable.
+        Under gevent this is one per greenlet, hence gthread workers.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    def _write(self, statements):
+        """Run (sql, params) pairs in one IMMEDIATE transaction."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for sql, params in statements:
+                conn.execute(sql, params)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def create(self, session_id=None):
+        session_id = session_id or str(uuid.uuid4())
+        self._write([
+            ("DELETE FROM messages WHERE session_id = ?", (session_id,)),
+            ("INSERT OR REPLACE INTO sessions (id, last_access, bytes) VALUES (?, ?, 0)", (session_id, time.time())),
+        ])
+        return session_id
+
+    def exists(self, session_id):
+        row = self._conn().execute("SELECT 1 FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        return row is not None
+
+    def get(self, session_id):
+        rows = self._conn().execute(
+            "SELECT message FROM messages WHERE session_id = ? ORDER BY seq", (session_id,)
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def append(self, session_id, message):
+        encoded = json.dumps(message)
+        size = len(encoded)
+        self._write([
+            (
+                "INSERT INTO sessions (id, last_access, bytes) VALUES (?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET last_access = excluded.last_access, bytes = bytes + excluded.bytes",
+                (session_id, time.time(), size),
+            ),
+            (
+                "INSERT INTO messages (session_id, seq, message, bytes) "
+                "SELECT ?, COALESCE(MAX(seq), -1) + 1, ?, ? FROM messages WHERE session_id = ?",
+                (session_id, encoded, size, session_id),
+            ),
+        ])
+
+    def pop(self, session_id):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT seq, message, bytes FROM messages WHERE session_id = ? ORDER BY seq DESC LIMIT 1",
+                (session_id,),
+            ).fetchone()
+            if row is not None:
+                conn.execute("DELETE FROM messages WHERE session_id = ? AND seq = ?", (session_id, row[0]))
+                conn.execute("UPDATE sessions SET bytes = bytes - ? WHERE id = ?", (row[2], session_id))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return json.loads(row[1]) if row else None
+
+    def replace(self, session_id, messages):
+        encoded = [json.dumps(m) for m in messages]
+        statements = [
+            ("DELETE FROM messages WHERE session_id = ?", (session_id,)),
+            (
+                "INSERT OR REPLACE INTO sessions (id, last_access, bytes) VALUES (?, ?, ?)",
+                (session_id, time.time(), sum(len(e) for e in encoded)),
+            ),
+        ]
+        statements.extend(
+            ("INSERT INTO messages (session_id, seq, message, bytes) VALUES (?, ?, ?, ?)", (session_id, seq, e, len(e)))
+            for seq, e in enumerate(encoded)
+        )
+        self._write(statements)
+
+    def delete(self, session_id):
+        self._write([
+            ("DELETE FROM messages WHERE session_id = ?", (session_id,)),
+            ("DELETE FROM sessions WHERE id = ?", (session_id,)),
+        ])
+
+    def put_image(self, digest, media_type, data):
+        self._write([(
+            "INSERT INTO images (digest, media_type, data, bytes, last_access) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(digest) DO UPDATE SET last_access = excluded.last_access",
+            (digest, media_type, data, len(data), time.time()),
+        )])
+
+    def get_image(self, digest):
+        row = self._conn().execute(
+            "SELECT media_type, data FROM images WHERE digest = ?", (digest,)
+        ).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def _drop_where(self, where, params):
+        conn = self._conn()
+        ids = [row[0] for row in conn.execute(f"SELECT id FROM sessions WHERE {where}", params).fetchall()]
+        for session_id in ids:
+            self.delete(session_id)
+        return len(ids)
+
+    def sweep(self):
+        """Drop idle sessions, then evict least recently used ones until within budget."""
+        expired = self._drop_where("last_access < ?", (time.time() - self.idle_ttl,))
+        self.expirations += expired
+
+        conn = self._conn()
+        count, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM sessions").fetchone()
+        while count > self.max_sessions or total > self.max_bytes:
+            row = conn.execute("SELECT id, bytes FROM sessions ORDER BY last_access LIMIT 1").fetchone()
+            if row is None:
+                break
+            self.delete(row[0])
+            self.evictions += 1
+            count -= 1
+            total -= row[1]
+
+        (image_total,) = conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM images").fetchone()
+        while image_total > self.max_image_bytes:
+            row = conn.execute("SELECT digest, bytes FROM images ORDER BY last_access LIMIT 1").fetchone()
+            if row is None:
+                break
+            conn.execute("DELETE FROM images WHERE digest = ?", (row[0],))
+            image_total -= row[1]
+        return expired
+
+    def stats(self):
+        count, total, messages, images, image_bytes = self._conn().execute(
+            "SELECT COUNT(*), COALESCE(SUM(bytes), 0), "
+            "(SELECT COUNT(*) FROM messages), "
+            "(SELECT COUNT(*) FROM images), "
+            "(SELECT COALESCE(SUM(bytes), 0) FROM images) FROM sessions"
+        ).fetchone()
+        return {
+            "backend": "sqlite",
+            "sessions": count,
+            "messages": messages,
+            "bytes": total,
+            "images": images,
+            "image_bytes": image_bytes,
+            "max_sessions": self.max_sessions,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
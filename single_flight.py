@@ -0,0 +1,140 @@
+"""
+Single-flight coalescing of identical upstream generations.
+
+When a class is told to ask the same question at once, dozens of identical
+requests arrive within seconds of each other. The first one starts the
+upstream call on a background thread. Every request with the same key that
+arrives while it runs subscribes to the same Flight instead of opening its
+own stream. A subscriber gets every chunk from the start, so one that joins
+mid-stream first catches up on the buffered text and then follows live.
+
+The generation does not belong to any one client. If the request that
+started it disconnects, the others still get the whole answer. Once every
+subscriber has gone, ``Flight.abandoned`` tells the producer to stop early.
+A flight is unregistered as soon as it finishes, so this never acts as a
+response cache.
+"""
+import threading
+
+
+class Flight:
+    """One upstream generation and its buffered text, shared by its subscribers."""
+
+    def __init__(self, group, key):
+        self.key = key
+        self.subscribers = 0
+        self.result = None
+        self.error = None
+        self._group = group
+        self._chunks = []
+        self._done = False
+        self._cond = threading.Condition()
+
+    def publish(self, text):
+        with self._cond:
+            self._chunks.append(text)
+            self._cond.notify_all()
+
+    def _finish(self, result=None, error=None):
+        with self._cond:
+            self.result = result
+            self.error = error
+            self._done = True
+            self._cond.notify_all()
+
+    @property
+    def abandoned(self):
+        """True once every subscriber has left; the flight then takes no new ones."""
+        return self._group._abandon(self)
+
+    def follow(self):
+        """
+        Yield the text from the start, then chunk by chunk as it arrives.
+        Raises the producer's exception if the generation failed.
+        """
+        index = 0
+        try:
+            while True:
+                with self._cond:
+                    while index == len(self._chunks) and not self._done:
+                        self._cond.wait()
+                    chunks = self._chunks[index:]
+                    done = self._done
+                index += len(chunks)
+                yield from chunks
+                if done:
+                    break
+        finally:
+            self._group._leave(self)
+        if self.error is not None:
+            raise self.error
+
+
+class SingleFlight:
+    """Registry of in-flight generations by request key."""
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.started = 0
+        self.joined = 0
+        self.abandoned = 0
+
+    def subscribe(self, key, produce):
+        """
+        Return ``(flight, started)``. If no flight for ``key`` is running,
+        start ``produce(flight) -> result`` on a background thread. With
+        ``key`` None the flight is private and nobody else can join it.
+        Call ``flight.follow()`` exactly once to read the text.
+        """
+        with self._lock:
+            flight = self._flights.get(key) if key is not None else None
+            started = flight is None
+            if started:
+                flight = Flight(self, key)
+                if key is not None:
+                    self._flights[key] = flight
+                self.started += 1
+            else:
+                self.joined += 1
+            flight.subscribers += 1
+        if started:
+            threading.Thread(
+                target=self._run, args=(flight, produce), name="upstream-flight", daemon=True
+            ).start()
+        return flight, started
+
+    def _run(self, flight, produce):
+        try:
+            flight._finish(result=produce(flight))
+        except Exception as e:
+            flight._finish(error=e)
+        finally:
+            self._unregister(flight)
+
+    def _unregister(self, flight):
+        with self._lock:
+            if flight.key is not None and self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+
+    def _leave(self, flight):
+        with self._lock:
+            flight.subscribers -= 1
+
+    def _abandon(self, flight):
+        with self._lock:
+            if flight.subscribers > 0:
+                return False
+            if flight.key is not None and self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+            self.abandoned += 1
+            return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._flights),
+                "started": self.started,
+                "joined": self.joined,
+                "abandoned": self.abandoned,
+            }
@@ -331,12 +331,27 @@ async function sendPayload(payload) {
                         rawText += data.text;
                         streamMessage.content.textContent = rawText;
                         scrollToBottom();
+                    } else if (data.type === "plot") {
+                        // Plot rendered while the answer is still streaming
+                        if (data.src) {
+                            const plot = document.createElement("div");
+                            plot.className = "plot-container";
+                            const img = document.createElement("img");
+                            img.src = data.src;
+                            img.alt = "Plot";
+                            img.className = "matplotlib-plot";
+                            plot.appendChild(img);
+                            streamMessage.plots.appendChild(plot);
+                            scrollToBottom();
+                        }
                     } else if (data.type === "done") {
                         sessionId = data.session_id;
                         renderAssistantMessage(streamMessage.div, data.response);
                         markLastUserDelivered();
                         hideErrorBanner();
                         completed = true;
+                    } else if (data.type === "timing") {
+                        console.debug("Response timing (ms)", data.timing);
                     } else if (data.type === "error") {
                         streamMessage.div.remove();
                         addErrorMessage(data.error);
@@ -478,9 +493,12 @@ function addAssistantMessageStream() {
     content.className = "assistant-stream";
     content.textContent = "";
     div.appendChild(content);
+    const plots = document.createElement("div");
+    plots.className = "assistant-stream-plots";
+    div.appendChild(plots);
     messagesEl.appendChild(div);
     scrollToBottom();
-    return { div, content };
+    return { div, content, plots };
 }
 
 function renderAssistantMessage(div, markdownText) {
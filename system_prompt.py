@@ -1,7 +1,23 @@
+import hashlib
 import os
+import threading
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
+# Source files of the system prompt, relative to BASE_DIR
+PROMPT_SOURCES = (
+    "CLAUDE.md",
+    os.path.join(".claude", "rules", "teaching-methodology.md"),
+    os.path.join(".claude", "rules", "problem-solving.md"),
+    os.path.join(".claude", "rules", "common-mistakes.md"),
+)
+
+# Re-read the sources when their mtimes change (dev only; defaults to FLASK_DEBUG)
+PROMPT_HOT_RELOAD = os.environ.get("PROMPT_HOT_RELOAD", os.environ.get("FLASK_DEBUG", "0")) == "1"
+
+_COMPILED_PROMPT = None
+_COMPILE_LOCK = threading.Lock()
+
 
 def _read_file(relative_path):
     """Read a file relative to the project root."""
@@ -10,13 +26,42 @@ def _read_file(relative_path):
         return f.read()
 
 
-def get_system_prompt():
+def approx_token_count(text):
+    """Cheap token estimate (~4 characters per token) for budgeting, not billing."""
+    return len(text) // 4 + 1
+
+
+class CompiledPrompt:
+    """The system prompt text plus metadata computed once when it is built."""
+
+    def __init__(self, text, mtimes):
+        self.text = text
+        self.mtimes = mtimes
+        self.sha256 = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        self.approx_tokens = approx_token_count(text)
+
+    def is_stale(self):
+        """True if any source file changed on disk since this prompt was built."""
+        return self.mtimes != _source_mtimes()
+
+
+def _source_mtimes():
+    mtimes = {}
+    for relative_path in PROMPT_SOURCES:
+        try:
+            mtimes[relative_path] = os.path.getmtime(os.path.join(BASE_DIR, relative_path))
+        except OSError:
+            mtimes[relative_path] = None
+    return mtimes
+
+
+def compile_system_prompt():
     """Compile all tutoring rules into a single system prompt."""
 
-    claude_md = _read_file("CLAUDE.md")
-    teaching = _read_file(os.path.join(".claude", "rules", "teaching-methodology.md"))
-    problem_solving = _read_file(os.path.join(".claude", "rules", "problem-solving.md"))
-    common_mistakes = _read_file(os.path.join(".claude", "rules", "common-mistakes.md"))
+    mtimes = _source_mtimes()
+    claude_md, teaching, problem_solving, common_mistakes = (
+        _read_file(relative_path) for relative_path in PROMPT_SOURCES
+    )
 
     web_instructions = """
 ## Web Interface Instructions
@@ -39,7 +84,7 @@ def get_system_prompt():
 - When showing step-by-step solutions, number each step clearly.
 """
 
-    return f"""{claude_md}
+    text = f"""{claude_md}
 
 ---
 
@@ -56,6 +101,24 @@ def get_system_prompt():
 ---
 
 {web_instructions}"""
+    return CompiledPrompt(text, mtimes)
+
+
+def get_compiled_prompt():
+    """Return the compiled prompt, building it on first use (or when stale in hot-reload mode)."""
+    global _COMPILED_PROMPT
+    compiled = _COMPILED_PROMPT
+    if compiled is not None and not (PROMPT_HOT_RELOAD and compiled.is_stale()):
+        return compiled
+    with _COMPILE_LOCK:
+        if _COMPILED_PROMPT is None or (PROMPT_HOT_RELOAD and _COMPILED_PROMPT.is_stale()):
+            _COMPILED_PROMPT = compile_system_prompt()
+        return _COMPILED_PROMPT
+
+
+def get_system_prompt():
+    """Return the compiled system prompt text."""
+    return get_compiled_prompt().text
 
 
 def get_mode_instruction(mode, user_text):
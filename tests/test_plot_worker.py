@@ -0,0 +1,50 @@
+import sys
+
+import pytest
+
+import plot_worker
+from plot_worker import PlotWorkerPool
+
+pytest.importorskip("matplotlib")
+
+PLOT_UP = "plt.plot([0, 1], [0, 1])"
+PLOT_DOWN = "plt.plot([0, 1], [1, 0])"
+
+
+@pytest.fixture
+def pool():
+    pool = PlotWorkerPool(sys.executable, size=1, max_jobs=50, timeout=10)
+    pool.start()
+    # A cold worker spends its first job's time importing matplotlib
+    assert pool.render(PLOT_UP) is not None
+    yield pool
+    pool.shutdown()
+
+
+def test_late_reply_is_not_read_by_the_next_job(pool, monkeypatch):
+    expected = pool.render(PLOT_DOWN)
+    # Give up on the worker a second before it replies to the slow job
+    monkeypatch.setattr(plot_worker, "_WORKER_GRACE", -1)
+    assert pool.render("import time\ntime.sleep(1.5)\n" + PLOT_UP, timeout=2) is None
+    monkeypatch.setattr(plot_worker, "_WORKER_GRACE", 5)
+
+    assert pool.render(PLOT_DOWN) == expected
+    assert pool.stats()["recycled"] == 1
+
+
+def test_timed_out_job_keeps_the_worker(pool):
+    assert pool.render("import time\ntime.sleep(5)", timeout=0.5) is None
+    stats = pool.stats()
+    assert stats["timed_out"] == 1
+    assert stats["recycled"] == 0
+    assert pool.render(PLOT_UP) is not None
+
+
+def test_jobs_do_not_share_files(pool):
+    assert pool.render("open('answer.txt', 'w').write('42')\n" + PLOT_UP) is not None
+    assert pool.render("import os\nassert os.listdir('.') == []\n" + PLOT_UP) is not None
+
+
+def test_job_cannot_read_the_protocol_stream(pool):
+    assert pool.render("import sys\nassert sys.stdin.read() == ''\n" + PLOT_UP) is not None
+    assert pool.render(PLOT_UP) is not None
@@ -0,0 +1,57 @@
+import types
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def budget(monkeypatch):
+    """Make the whole context budget available to messages, in estimated tokens."""
+    monkeypatch.setattr(app, "get_compiled_prompt", lambda: types.SimpleNamespace(approx_tokens=0))
+    monkeypatch.setattr(app, "MAX_TOKENS", 0)
+
+    def set_budget(tokens):
+        monkeypatch.setattr(app, "CONTEXT_TOKEN_BUDGET", tokens)
+
+    return set_budget
+
+
+def _message(role, tokens):
+    return app._history_message(role, "x" * (tokens * 4))
+
+
+def _tokens(messages):
+    return sum(app._message_tokens(m) for m in messages)
+
+
+def test_oversized_new_turn_alone_is_kept(budget):
+    budget(10)
+    messages = [_message("user", 200)]
+    assert app.trim_conversation(messages) == messages
+
+
+def test_oversized_new_turn_drops_all_history(budget):
+    budget(10)
+    new_turn = _message("user", 200)
+    messages = [_message("user", 5), _message("assistant", 5), new_turn]
+    assert app.trim_conversation(messages) == [new_turn]
+
+
+def test_leading_assistant_message_is_dropped(budget):
+    budget(1000)
+    messages = [_message("assistant", 5), _message("user", 5), _message("assistant", 5), _message("user", 5)]
+    trimmed = app.trim_conversation(messages)
+    assert trimmed == messages[1:]
+    assert trimmed[0]["role"] == "user"
+
+
+def test_over_budget_drops_middle_exchanges_first(budget):
+    opening = [_message("user", 10), _message("assistant", 10)]
+    middle = [_message("user", 10), _message("assistant", 10)]
+    latest = [_message("user", 10), _message("assistant", 10)]
+    new_turn = [_message("user", 10)]
+    messages = opening + middle + latest + new_turn
+    budget(_tokens(opening + latest + new_turn))
+
+    assert app.trim_conversation(messages) == opening + latest + new_turn